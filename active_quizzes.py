@@ -0,0 +1,75 @@
+import datetime
+import time
+
+from pymongo import InsertOne, UpdateOne
+
+from indexes import ACTIVE_QUIZ_TTL_SECONDS
+from logger_config import setup_logger
+from scheduler import DeadlineScheduler
+
+
+class ActiveQuizIndex:
+    """In-memory map of message id -> active quiz, with a set of users who already answered.
+
+    Memory is authoritative: reaction handling is a dict lookup, so reactions on non-quiz messages cost nothing.
+    Quizzes expire from memory through a deadline heap and from Mongo through the TTL index on `start_time`; Mongo is
+    written behind through the write buffer and only read once, by `load`, to rehydrate after a restart.
+    """
+    LOG = setup_logger("ActiveQuizIndex")
+
+    def __init__(self, active_quizzes_collection, write_buffer, ttl=ACTIVE_QUIZ_TTL_SECONDS):
+        self.active_quizzes_collection = active_quizzes_collection
+        self.write_buffer = write_buffer
+        self.ttl = ttl
+        self._quizzes = {}
+        self._expiry = DeadlineScheduler("ActiveQuizExpiry")
+
+    def __len__(self):
+        return len(self._quizzes)
+
+    def get(self, message_id):
+        return self._quizzes.get(message_id)
+
+    async def load(self):
+        self._expiry.start()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        for active_quiz in await self.active_quizzes_collection.find({'start_time': {'$gte': cutoff}}):
+            self._track(active_quiz['message_id'], active_quiz['quiz'], active_quiz['start_time'],
+                        set(active_quiz.get('answered_by', [])))
+        self.LOG.info(f"rehydrated {len(self._quizzes)} active quizzes")
+
+    def close(self):
+        self._expiry.stop()
+
+    def add(self, message_id, quiz):
+        start_time = datetime.datetime.utcnow()
+        self._track(message_id, quiz, start_time, set())
+        self.write_buffer.add(self.active_quizzes_collection, InsertOne({
+            'message_id': message_id,
+            'quiz': quiz,
+            'start_time': start_time,
+            'answered_by': []
+        }))
+
+    def record_answer(self, message_id, user_id):
+        """Mark `user_id` as having answered; False if the quiz is unknown or they already answered."""
+        active_quiz = self._quizzes.get(message_id)
+        if active_quiz is None or user_id in active_quiz['answered_by']:
+            return False
+        active_quiz['answered_by'].add(user_id)
+        self.write_buffer.add(self.active_quizzes_collection, UpdateOne(
+            {'message_id': message_id},
+            {
+                '$addToSet': {'answered_by': user_id},
+                '$currentDate': {'last_interaction': True}
+            }
+        ))
+        return True
+
+    def _track(self, message_id, quiz, start_time, answered_by):
+        self._quizzes[message_id] = {'quiz': quiz, 'answered_by': answered_by}
+        expires_at = start_time.replace(tzinfo=datetime.timezone.utc).timestamp() + self.ttl
+        self._expiry.schedule(message_id, max(expires_at, time.time()), lambda: self._expire(message_id))
+
+    async def _expire(self, message_id):
+        self._quizzes.pop(message_id, None)
@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+MONGO_EXECUTOR_WORKERS = int(os.getenv('MONGO_EXECUTOR_WORKERS', 16))
+
+
+class AsyncCollection:
+    """Awaitable wrapper around a pymongo collection.
+
+    Every call runs on the database thread pool, so a slow query never blocks the discord.py event loop.
+    Cursor-returning calls (find, aggregate) are materialized into lists on the worker thread.
+    """
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self.name = collection.name
+        self._executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return await self._run(self.collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs):
+        return await self._run(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return await self._run(lambda: list(self.collection.aggregate(pipeline, **kwargs)))
+
+    async def count_documents(self, *args, **kwargs):
+        return await self._run(self.collection.count_documents, *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self._run(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run(self.collection.update_one, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self._run(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def replace_one(self, *args, **kwargs):
+        return await self._run(self.collection.replace_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._run(self.collection.update_many, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run(self.collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run(self.collection.delete_many, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run(self.collection.bulk_write, *args, **kwargs)
+
+    async def create_indexes(self, *args, **kwargs):
+        return await self._run(self.collection.create_indexes, *args, **kwargs)
+
+    async def explain(self, *args, **kwargs):
+        return await self._run(lambda: self.collection.find(*args, **kwargs).explain())
+
+
+class AsyncDatabase:
+    """Shared async repository layer over the bot's pymongo database."""
+
+    def __init__(self, database, max_workers=MONGO_EXECUTOR_WORKERS):
+        self.database = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mongo")
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = AsyncCollection(self.database[name], self._executor)
+        return self._collections[name]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
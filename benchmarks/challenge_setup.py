@@ -0,0 +1,110 @@
+"""Latency of `!study_challenge` setup with simulated Discord REST latency.
+
+Every Discord call (member lookup, channel creation, invite, message send) sleeps for `--rest-latency`; Mongo is an
+in-memory mongomock database. The target is under one second for a 25-person challenge.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/challenge_setup.py --members 25 --rest-latency 0.1
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import mongomock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_db import AsyncDatabase  # noqa: E402
+from challenge_cog import ChallengeCog, MemberList  # noqa: E402
+from sessions import StudySessions  # noqa: E402
+from write_buffer import WriteBuffer  # noqa: E402
+
+ids = itertools.count(1)
+
+
+class FakeObject(SimpleNamespace):
+    # Members and roles are permission-overwrite keys
+    __hash__ = object.__hash__
+
+
+class FakeChannel:
+    def __init__(self, latency):
+        self.latency = latency
+        self.id = next(ids)
+        self.mention = f"<#{self.id}>"
+
+    async def send(self, content=None, embed=None):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(id=next(ids))
+
+    async def create_invite(self):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(url="https://discord.gg/bench")
+
+
+class FakeGuild:
+    def __init__(self, latency):
+        self.latency = latency
+        self.id = next(ids)
+        self.default_role = FakeObject(id=self.id)
+        self.me = FakeObject(id=0)
+
+    async def create_text_channel(self, name, overwrites=None):
+        await asyncio.sleep(self.latency)
+        return FakeChannel(self.latency)
+
+
+class FakeConverter:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def convert(self, ctx, argument):
+        await asyncio.sleep(self.latency)
+        return FakeObject(id=int(argument), bot=False, mention=f"<@{argument}>")
+
+
+async def run(members, rest_latency, rounds):
+    db = AsyncDatabase(mongomock.MongoClient()['bench'])
+    write_buffer = WriteBuffer()
+    write_buffer.start()
+    service = SimpleNamespace(add_study_time=lambda *args: None)
+    sessions = StudySessions(db['study_times'], service, service, service, write_buffer)
+    dispatcher = SimpleNamespace(send=lambda *args, **kwargs: None)
+    cog = ChallengeCog(SimpleNamespace(), db['challenge'], sessions, dispatcher)
+    cog.converter = FakeConverter(rest_latency)
+
+    samples = []
+    for _ in range(rounds):
+        channel = FakeChannel(rest_latency)
+        ctx = SimpleNamespace(guild=FakeGuild(rest_latency), channel=channel, send=channel.send)
+        member_list = MemberList()
+        for _ in range(members):
+            member_list.add_member(str(next(ids)))
+        started = time.perf_counter()
+        await cog.study_challenge.callback(cog, ctx, 30, member_list)
+        samples.append(time.perf_counter() - started)
+    cog.finalizer.stop()
+    await write_buffer.close()
+    db.close()
+
+    samples.sort()
+    print(f"members={members} rest_latency={rest_latency * 1000:.0f}ms rounds={rounds} "
+          f"setup p50={samples[len(samples) // 2] * 1000:.0f}ms max={samples[-1] * 1000:.0f}ms "
+          f"({'within' if samples[-1] < 1 else 'over'} the 1s target)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, default=25)
+    parser.add_argument('--rest-latency', type=float, default=0.1, help="seconds per simulated Discord call")
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.members, args.rest_latency, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
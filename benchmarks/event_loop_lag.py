@@ -0,0 +1,140 @@
+"""Event-loop lag under concurrent !ci/!co traffic.
+
+Drives StudyCog.check_in/check_out callbacks against a collection that blocks like a slow pymongo call and
+samples how late a 10ms ticker wakes up. Run once with the blocking collections used directly on the loop
+and once through AsyncCollection:
+
+    python benchmarks/event_loop_lag.py --users 200 --query-latency 0.005
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_db import AsyncCollection  # noqa: E402
+from sessions import StudySessions  # noqa: E402
+from study_cog import StudyCog  # noqa: E402
+from write_buffer import WriteBuffer  # noqa: E402
+
+
+class SlowCollection:
+    """Minimal in-memory stand-in for a pymongo collection where every call takes `latency` seconds."""
+
+    def __init__(self, name, latency):
+        self.name = name
+        self.latency = latency
+        self.docs = {}
+
+    def _key(self, query):
+        return query.get('user_id'), query.get('channel_id')
+
+    def find_one(self, query):
+        time.sleep(self.latency)
+        return self.docs.get(self._key(query))
+
+    def find(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return []
+
+    def update_one(self, query, update, upsert=False):
+        time.sleep(self.latency)
+        doc = self.docs.setdefault(self._key(query), dict(query))
+        doc.update(update.get('$set', {}))
+        for field, value in update.get('$inc', {}).items():
+            doc[field] = doc.get(field, 0) + value
+        for field in update.get('$unset', {}):
+            doc.pop(field, None)
+        return doc
+
+    def find_one_and_update(self, query, update, upsert=False, **kwargs):
+        return dict(self.update_one(query, update, upsert))
+
+    def update_many(self, *args, **kwargs):
+        time.sleep(self.latency)
+
+    def bulk_write(self, *args, **kwargs):
+        time.sleep(self.latency)
+
+
+class BlockingCollection:
+    """The pre-async behaviour: awaitable methods that run the blocking call on the event loop thread."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        func = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            return func(*args, **kwargs)
+
+        return call
+
+
+def make_ctx(user_id, channel_id):
+    async def send(*args, **kwargs):
+        pass
+
+    author = SimpleNamespace(id=user_id, mention=f"<@{user_id}>")
+    return SimpleNamespace(message=SimpleNamespace(author=author), author=author,
+                           channel=SimpleNamespace(id=channel_id), guild=None, send=send)
+
+
+async def measure_lag(stop, samples, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run(mode, users, latency):
+    collections = [SlowCollection(name, latency) for name in ('study_times', 'timers', 'user_daily_study_time')]
+    if mode == 'blocking':
+        wrapped = [BlockingCollection(c) for c in collections]
+    else:
+        executor = ThreadPoolExecutor(max_workers=16)
+        wrapped = [AsyncCollection(c, executor) for c in collections]
+    bot = SimpleNamespace(guilds=[], get_user=lambda user_id: None)
+    service = SimpleNamespace(add_study_time=lambda *args: None)
+    write_buffer = WriteBuffer()
+    write_buffer.start()
+    sessions = StudySessions(wrapped[0], service, service, service, write_buffer)
+    cog = StudyCog(bot, sessions, wrapped[1], None, None, None, None)
+    cog.daily_rollover.cancel()
+
+    stop = asyncio.Event()
+    samples = []
+    ticker = asyncio.create_task(measure_lag(stop, samples))
+    started = time.perf_counter()
+    ctxs = [make_ctx(user_id, 1) for user_id in range(users)]
+    await asyncio.gather(*(StudyCog.check_in.callback(cog, ctx) for ctx in ctxs))
+    await asyncio.gather(*(StudyCog.check_out.callback(cog, ctx) for ctx in ctxs))
+    await write_buffer.close()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+
+    samples = sorted(samples) or [0.0]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{mode:<9} commands={users * 2:<6} elapsed={elapsed:.3f}s "
+          f"lag p50={statistics.median(samples) * 1000:.2f}ms p99={p99 * 1000:.2f}ms "
+          f"max={samples[-1] * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--query-latency', type=float, default=0.005, help="seconds per simulated Mongo call")
+    args = parser.parse_args()
+    for mode in ('blocking', 'executor'):
+        asyncio.run(run(mode, args.users, args.query_latency))
+
+
+if __name__ == '__main__':
+    main()
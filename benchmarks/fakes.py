@@ -0,0 +1,184 @@
+"""Minimal stand-ins for the discord.py objects the cogs touch, for driving command callbacks offline.
+
+Every REST-backed call (`send`, `add_reaction`, `edit`, ...) sleeps for the `rest_latency` it was created with and
+counts itself in `REST_CALLS`, so scenarios can report how much Discord traffic they would generate.
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+REST_CALLS = Counter()
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+async def rest(kind, latency):
+    REST_CALLS[kind] += 1
+    if latency:
+        await asyncio.sleep(latency)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, author=None):
+        self.id = next_id()
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.author = author
+
+    async def add_reaction(self, emoji):
+        await rest('add_reaction', self.channel.rest_latency)
+
+    async def edit(self, **kwargs):
+        await rest('edit_message', self.channel.rest_latency)
+
+
+class FakeMember:
+    def __init__(self, guild=None, bot=False, rest_latency=0):
+        self.id = next_id()
+        self.guild = guild
+        self.bot = bot
+        self.rest_latency = rest_latency
+        self.display_name = self.name = f"user{self.id % 100000}"
+        self.mention = f"<@{self.id}>"
+
+    # Members are dict keys (permission overwrites) and compared to bot.user
+    __hash__ = object.__hash__
+
+    async def send(self, content=None, embed=None):
+        await rest('dm', self.rest_latency)
+        return FakeMessage(self, content, embed)
+
+
+class FakeChannel:
+    def __init__(self, guild=None, rest_latency=0):
+        self.id = next_id()
+        self.guild = guild
+        self.rest_latency = rest_latency
+        self.mention = f"<#{self.id}>"
+        self.messages = {}
+
+    async def send(self, content=None, embed=None, file=None):
+        await rest('send', self.rest_latency)
+        message = FakeMessage(self, content, embed)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await rest('fetch_message', self.rest_latency)
+        return self.messages[message_id]
+
+    def permissions_for(self, member):
+        return SimpleNamespace(send_messages=True, embed_links=True, add_reactions=True)
+
+
+class FakeGuild:
+    def __init__(self, members=0, channels=1, rest_latency=0):
+        self.id = next_id()
+        self.rest_latency = rest_latency
+        self.me = FakeMember(self, bot=True)
+        self.default_role = SimpleNamespace(id=self.id)
+        self.system_channel = None
+        self.channels = [FakeChannel(self, rest_latency) for _ in range(channels)]
+        self._members = {}
+        for _ in range(members):
+            member = FakeMember(self, rest_latency=rest_latency)
+            self._members[member.id] = member
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.channels if channel.id == channel_id), None)
+
+
+class FakeReaction:
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+
+
+class FakeContext:
+    """What a command callback sees: `ctx.author`/`ctx.message.author`, `ctx.channel`, `ctx.guild` and `ctx.send`."""
+
+    def __init__(self, author, channel):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.message = FakeMessage(channel, author=author)
+        self.sent = []
+
+    async def send(self, content=None, embed=None, file=None):
+        self.sent.append(content if content is not None else embed)
+        return await self.channel.send(content, embed=embed, file=file)
+
+
+class FakeBot:
+    """The bot attributes the cogs and services read, over a fixed set of fake guilds."""
+
+    def __init__(self, guilds):
+        self.guilds = guilds
+        self.user = FakeMember(bot=True)
+        self.latency = 0.05
+        self.tree = SimpleNamespace(sync=None)
+        self._users = {member.id: member for guild in guilds for member in guild.members}
+        self._channels = {channel.id: channel for guild in guilds for channel in guild.channels}
+        self._ready = asyncio.Event()
+        self._ready.set()
+
+    def get_user(self, user_id):
+        return self._users.get(user_id)
+
+    async def fetch_user(self, user_id):
+        await rest('fetch_user', 0)
+        return self._users[user_id]
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def owns_guild(self, guild_id):
+        return True
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+
+class LatentCollection:
+    """Wraps a (mongomock) collection so every call first blocks its executor thread for `latency` seconds."""
+
+    def __init__(self, collection, latency):
+        self._collection = collection
+        self._latency = latency
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            time.sleep(self._latency)
+            return attribute(*args, **kwargs)
+        return call
+
+
+class LatentDatabase:
+    def __init__(self, database, latency):
+        self._database = database
+        self._latency = latency
+
+    def __getitem__(self, name):
+        collection = self._database[name]
+        return LatentCollection(collection, self._latency) if self._latency else collection
@@ -0,0 +1,258 @@
+"""Offline load test: drive the real cogs and services with fake Discord objects and report throughput and latency.
+
+Scenarios (run all of them, or pick with `--scenario`):
+
+  checkin_storm      every user runs !ci then !co in one of the channels
+  quiz_burst         a quiz is posted and every user reacts to it with an answer
+  leaderboard_spam   every user runs one of !lb, !olb, !rk, !report after the storm filled the boards
+  midnight_rollover  the daily rollover runs while every user checks in
+
+Mongo is an in-memory mongomock database unless `--mongo-uri` points at a real (local) mongod; mongomock scans
+collections linearly, so use a real mongod for runs above a few thousand users. `--mongo-latency` adds a blocking
+delay to every Mongo call and `--rest-latency` to every Discord call. Results can be written with `--json` and
+compared against an earlier run with `--compare`, so commits can be checked against each other:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/load_test.py --users 2000 --json before.json
+    python benchmarks/load_test.py --users 2000 --compare before.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from active_quizzes import ActiveQuizIndex  # noqa: E402
+from async_db import AsyncDatabase  # noqa: E402
+from benchmarks.fakes import REST_CALLS, FakeBot, FakeContext, FakeGuild, FakeReaction, LatentDatabase  # noqa: E402
+from charts import ChartRenderer  # noqa: E402
+from dispatcher import MessageDispatcher  # noqa: E402
+from guild_config import GuildConfigService  # noqa: E402
+from indexes import apply_indexes  # noqa: E402
+from leaderboard import LeaderboardService  # noqa: E402
+from leases import LeaseManager  # noqa: E402
+from quiz_bank import QuizBank  # noqa: E402
+from quiz_cog import ANSWER_EMOJIS, QuizCog  # noqa: E402
+from rollover import DailyRollover  # noqa: E402
+from sessions import StudySessions  # noqa: E402
+from spaced_repetition import ReviewScheduler  # noqa: E402
+from stats_cog import StatsCog  # noqa: E402
+from study_cog import StudyCog  # noqa: E402
+from study_history import StudyHistory  # noqa: E402
+from user_resolver import UserNameResolver  # noqa: E402
+from user_stats import UserStatsService  # noqa: E402
+from write_buffer import WriteBuffer  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['checkin_storm', 'quiz_burst', 'leaderboard_spam', 'midnight_rollover']
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Harness:
+    """The services and cogs wired up the way StudyBot does it, on a fresh database and a fake guild."""
+
+    def __init__(self, args, database):
+        self.args = args
+        self.db = AsyncDatabase(LatentDatabase(database, args.mongo_latency))
+        self.guild = FakeGuild(members=args.users, channels=args.channels, rest_latency=args.rest_latency)
+        self.bot = FakeBot([self.guild])
+        self.write_buffer = WriteBuffer()
+        self.dispatcher = MessageDispatcher(self.bot)
+        self.user_stats = UserStatsService(self.db['user_stats'], self.write_buffer)
+        self.leaderboards = LeaderboardService(self.db['study_rollups'], self.write_buffer)
+        self.study_history = StudyHistory(self.db['study_history'], self.write_buffer)
+        self.sessions = StudySessions(self.db['study_times'], self.study_history, self.leaderboards, self.user_stats,
+                                      self.write_buffer)
+        self.rollover = DailyRollover(self.db['study_times'], self.db['jobs'], self.write_buffer)
+        self.leases = LeaseManager(self.db['leases'])
+        self.guild_config = GuildConfigService(self.db['guild_config'])
+        self.quiz_bank = QuizBank(self.db['quiz_collection'], self.db['quiz_meta'])
+        self.active_quizzes = ActiveQuizIndex(self.db['active_quizzes'], self.write_buffer)
+        self.reviews = ReviewScheduler(self.db['review_schedule'], self.quiz_bank, self.write_buffer)
+        self.charts = ChartRenderer()
+
+    async def start(self):
+        self.write_buffer.start()
+        self.dispatcher.start()
+        await apply_indexes(self.db)
+        with open(os.path.join(ROOT, 'quizzes.json')) as f:
+            await self.quiz_bank.seed(json.load(f))
+        await asyncio.gather(self.guild_config.load(),
+                             self.leaderboards.load(self.bot, self.db['study_times'], self.leases),
+                             self.user_stats.load(self.db['study_times'], self.db['user_answers'],
+                                                  self.db['user_daily_study_time'], self.leases),
+                             self.study_history.load(self.db['user_daily_study_time'], self.leases))
+        self.study_cog = StudyCog(self.bot, self.sessions, self.db['timers'], None, self.rollover, self.dispatcher,
+                                  self.leases)
+        self.quiz_cog = QuizCog(self.bot, self.quiz_bank, self.active_quizzes, self.db['user_answers'], self.user_stats,
+                                self.dispatcher, self.write_buffer, self.guild_config, self.reviews)
+        self.stats_cog = StatsCog(self.bot, self.db['user_levels'], self.user_stats, UserNameResolver(self.bot),
+                                  self.leaderboards, self.dispatcher, self.study_history, self.charts)
+        # The cogs' own loops wait for wall-clock times that never come during a run
+        await self.study_cog.cog_load()
+        await self.quiz_cog.cog_load()
+        self.stats_cog.progress_reports.cancel()
+
+    async def close(self):
+        self.study_cog.cog_unload()
+        self.quiz_cog.cog_unload()
+        self.active_quizzes.close()
+        await self.dispatcher.close()
+        await self.write_buffer.close()
+        self.charts.close()
+        self.db.close()
+
+    def context(self, member, channel=None):
+        return FakeContext(member, channel or random.choice(self.guild.channels))
+
+    async def timed(self, calls):
+        """Run the coroutine factories in `calls` with at most `--concurrency` in flight; returns (latencies, seconds)."""
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def run(call):
+            async with semaphore:
+                started = time.perf_counter()
+                await call()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run(call) for call in calls))
+        return latencies, time.perf_counter() - started
+
+    async def checkin_storm(self):
+        contexts = [self.context(member) for member in self.guild.members]
+        check_ins, check_in_seconds = await self.timed(
+            [lambda ctx=ctx: StudyCog.check_in.callback(self.study_cog, ctx) for ctx in contexts])
+        check_outs, check_out_seconds = await self.timed(
+            [lambda ctx=ctx: StudyCog.check_out.callback(self.study_cog, ctx) for ctx in contexts])
+        return check_ins + check_outs, check_in_seconds + check_out_seconds
+
+    async def quiz_burst(self):
+        message = await self.quiz_cog.post_quiz(self.guild.channels[0], self.guild.channels[0].id)
+        reactions = [(FakeReaction(message, random.choice(ANSWER_EMOJIS)), member) for member in self.guild.members]
+        return await self.timed([lambda reaction=reaction, member=member: self.quiz_cog.on_reaction_add(reaction, member)
+                                 for reaction, member in reactions])
+
+    async def leaderboard_spam(self):
+        await self.checkin_storm()
+        await self.write_buffer.flush()
+        REST_CALLS.clear()
+        commands = [StatsCog.leaderboard, StatsCog.overall_leaderboard, StatsCog.rank, StatsCog.report]
+        return await self.timed([lambda ctx=self.context(member), command=random.choice(commands):
+                                 command.callback(self.stats_cog, ctx) for member in self.guild.members])
+
+    async def midnight_rollover(self):
+        # Yesterday's sessions leave daily study time on every study_times document for the rollover to reset
+        await self.checkin_storm()
+        await self.write_buffer.flush()
+        REST_CALLS.clear()
+        date = datetime.date.today().strftime('%Y-%m-%d')
+        contexts = [self.context(member) for member in self.guild.members]
+        # Latencies are the check-ins'; the elapsed time also covers the rollover finishing
+        started = time.perf_counter()
+        (latencies, _), _ = await asyncio.gather(
+            self.timed([lambda ctx=ctx: StudyCog.check_in.callback(self.study_cog, ctx) for ctx in contexts]),
+            self.study_cog.run_rollover(self.rollover.run, date))
+        return latencies, time.perf_counter() - started
+
+
+async def run_scenario(args, name, database):
+    harness = Harness(args, database)
+    await harness.start()
+    REST_CALLS.clear()
+    try:
+        latencies, seconds = await getattr(harness, name)()
+    finally:
+        await harness.close()
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2),
+        'rest_calls': sum(REST_CALLS.values()),
+    }
+
+
+def open_database(args, name):
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongo_uri)
+        client.drop_database(name)
+        return client[name]
+    import mongomock
+    return mongomock.MongoClient()[name]
+
+
+def print_report(results, baseline=None):
+    print(f"{'scenario':<18} {'ops':>7} {'seconds':>8} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'REST':>7}")
+    for name, result in results['scenarios'].items():
+        print(f"{name:<18} {result['ops']:>7} {result['seconds']:>8.2f} {result['throughput']:>9.1f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['max_ms']:>8.2f} {result['rest_calls']:>7}")
+        previous = (baseline or {}).get('scenarios', {}).get(name)
+        if previous:
+            def change(key):
+                return f"{(result[key] - previous[key]) / previous[key]:+.1%}" if previous[key] else "n/a"
+            print(f"{'  vs ' + baseline['commit']:<18} {'':>7} {'':>8} {change('throughput'):>9} "
+                  f"{change('p50_ms'):>8} {change('p99_ms'):>8} {change('max_ms'):>8}")
+
+
+async def run(args):
+    results = {'commit': git_commit(), 'config': {key: value for key, value in vars(args).items()
+                                                   if key not in ('json', 'compare', 'mongo_uri')}, 'scenarios': {}}
+    for name in args.scenario or SCENARIOS:
+        random.seed(args.seed)
+        results['scenarios'][name] = await run_scenario(args, name, open_database(args, f"load_test_{name}"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="run only this scenario (repeatable)")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=500, help="commands in flight at once")
+    parser.add_argument('--rest-latency', type=float, default=0.0, help="seconds per simulated Discord call")
+    parser.add_argument('--mongo-latency', type=float, default=0.0, help="extra seconds per Mongo call")
+    parser.add_argument('--mongo-uri', help="use this mongod instead of mongomock (its load_test_* databases are dropped)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="print the change against results written earlier with --json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print(f"warning: {args.compare} was recorded with different settings: {baseline.get('config')}")
+    print(f"commit {results['commit']}, {args.users} users, {'mongod' if args.mongo_uri else 'mongomock'}")
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Firing accuracy of DeadlineScheduler with many concurrent timers.
+
+    python benchmarks/scheduler_accuracy.py --timers 50000 --spread 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import DeadlineScheduler  # noqa: E402
+
+
+async def run(timers, spread):
+    scheduler = DeadlineScheduler("BenchScheduler")
+    scheduler.start()
+    lateness = []
+    done = asyncio.Event()
+
+    def make_callback(deadline):
+        async def callback():
+            lateness.append(time.time() - deadline)
+            if len(lateness) == timers:
+                done.set()
+        return callback
+
+    started = time.time()
+    for key in range(timers):
+        deadline = started + 0.5 + random.random() * spread
+        scheduler.schedule(key, deadline, make_callback(deadline))
+    scheduled = time.time() - started
+    await done.wait()
+    scheduler.stop()
+
+    lateness.sort()
+    print(f"timers={timers} schedule_time={scheduled:.3f}s "
+          f"lateness p50={lateness[len(lateness) // 2] * 1000:.2f}ms "
+          f"p99={lateness[min(len(lateness) - 1, int(len(lateness) * 0.99))] * 1000:.2f}ms "
+          f"max={lateness[-1] * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--timers', type=int, default=50000)
+    parser.add_argument('--spread', type=float, default=5.0, help="seconds over which deadlines are spread")
+    args = parser.parse_args()
+    asyncio.run(run(args.timers, args.spread))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Check-in/check-out commands per second: StudySessions against the old find_one-then-write path.
+
+Runs against an in-memory mongomock database, so the numbers measure per-command overhead (round trips through the
+executor, buffered vs inline writes) rather than network latency.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/session_throughput.py --users 2000 --rounds 3
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import mongomock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_db import AsyncDatabase  # noqa: E402
+from sessions import StudySessions  # noqa: E402
+from study_history import StudyHistory  # noqa: E402
+from write_buffer import WriteBuffer  # noqa: E402
+
+
+async def legacy_check_in(study_times, user_id, channel_id):
+    user_data = await study_times.find_one({'user_id': user_id, 'channel_id': channel_id})
+    if user_data and 'check_in_time' in user_data:
+        return False
+    await study_times.update_one(
+        {'user_id': user_id, 'channel_id': channel_id},
+        {'$set': {'check_in_time': datetime.datetime.now()}},
+        upsert=True
+    )
+    return True
+
+
+async def legacy_check_out(study_times, user_daily, user_id, channel_id):
+    user_data = await study_times.find_one({'user_id': user_id, 'channel_id': channel_id})
+    if not user_data or 'check_in_time' not in user_data:
+        return None
+    now = datetime.datetime.now()
+    study_time = (now - user_data['check_in_time']).total_seconds()
+    await study_times.update_one(
+        {'user_id': user_id, 'channel_id': channel_id},
+        {'$inc': {'total_study_time': study_time, 'daily_study_time': study_time}, '$unset': {'check_in_time': ""}}
+    )
+    await user_daily.update_one(
+        {'user_id': user_id, 'channel_id': channel_id, 'date': now.strftime('%Y-%m-%d')},
+        {'$inc': {'study_time_this_day': study_time}},
+        upsert=True
+    )
+    return study_time
+
+
+async def run_legacy(db, users, rounds):
+    study_times, user_daily = db['study_times'], db['user_daily_study_time']
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(legacy_check_in(study_times, str(user), 'bench') for user in range(users)))
+        # The double check-in costs a find_one on this path
+        await asyncio.gather(*(legacy_check_in(study_times, str(user), 'bench') for user in range(users)))
+        await asyncio.gather(*(legacy_check_out(study_times, user_daily, str(user), 'bench') for user in range(users)))
+    return time.perf_counter() - started
+
+
+async def run_cached(db, users, rounds):
+    write_buffer = WriteBuffer()
+    write_buffer.start()
+    service = SimpleNamespace(add_study_time=lambda *args: None)
+    history = StudyHistory(db['study_history'], write_buffer)
+    sessions = StudySessions(db['study_times'], history, service, service, write_buffer)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(sessions.check_in(str(user), 'bench') for user in range(users)))
+        await asyncio.gather(*(sessions.check_in(str(user), 'bench') for user in range(users)))
+        for user in range(users):
+            sessions.check_out(str(user), 'bench', None)
+    elapsed = time.perf_counter() - started
+    await write_buffer.close()
+    return elapsed
+
+
+async def run(users, rounds):
+    commands = users * rounds * 3
+    for name, runner in (('legacy', run_legacy), ('cached', run_cached)):
+        db = AsyncDatabase(mongomock.MongoClient()['bench'])
+        elapsed = await runner(db, users, rounds)
+        db.close()
+        print(f"{name:8}  commands={commands:<7} elapsed={elapsed:.3f}s  {commands / elapsed:,.0f} commands/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3, help="check-in, double check-in, check-out cycles per user")
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
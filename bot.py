@@ -1,5 +1,10 @@
+import asyncio
+import contextlib
+import hashlib
 import json
 import os
+import signal
+import time
 from difflib import get_close_matches
 
 import discord
@@ -8,58 +13,196 @@ from discord.ext import commands
 from dotenv import load_dotenv
 from pymongo import MongoClient
 
-from challenge_cog import ChallengeCog
+from active_quizzes import ActiveQuizIndex
+from async_db import AsyncDatabase
+from charts import ChartRenderer
+from dispatcher import MessageDispatcher
+from guild_config import GuildConfigService
 from help import CustomHelpCommand
+from indexes import apply_indexes, audit_query_plans
+from leases import LeaseManager
+from metrics import METRICS, MetricsServer, MongoCommandListener, instrument_bot, instrument_loops
+from leaderboard import LeaderboardService
+from rollover import DailyRollover
+from sessions import StudySessions
+from spaced_repetition import ReviewScheduler
+from throttle import Throttled, UserRateLimiter
+from study_history import StudyHistory
 from logger_config import setup_logger
-from quiz_cog import QuizCog
-from stats_cog import StatsCog
-from study_cog import StudyCog
+from quiz_bank import QuizBank
+from user_resolver import UserNameResolver
+from user_stats import UserStatsService
+from voice_presence import VoicePresence
+from write_buffer import WriteBuffer
 
 timezone = pytz.timezone('America/New_York')
 load_dotenv()  # take environment variables from .env.
-GUILDS_ID = discord.Object(id=os.getenv('GUILD_ID'))
+# Optional: a development guild that slash commands are copied to, so they show up without global sync delay.
+GUILDS_ID = discord.Object(id=os.getenv('GUILD_ID')) if os.getenv('GUILD_ID') else None
+# Optional: run a slice of the shards in this process, e.g. SHARD_COUNT=4 and SHARD_IDS=0,1 / SHARD_IDS=2,3.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+EXTENSIONS = ['study_cog', 'quiz_cog', 'challenge_cog', 'stats_cog', 'perf_cog', 'voice_cog']
 
 
-class StudyBot(commands.Bot):
+class StudyBot(commands.AutoShardedBot):
     LOG = setup_logger("StudyBot")
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cogs_added = False
-        self.mongo_client = MongoClient(os.getenv('MONGODB_CONNECTION_STRING'))
+        self.startup_started = time.perf_counter()
+        self.startup_timings = {}
+        self.startup_reported = False
+        self.dev_guild = GUILDS_ID
+        self.mongo_client = MongoClient(os.getenv('MONGODB_CONNECTION_STRING'), event_listeners=[MongoCommandListener()])
         self.LOG.info(f"initialized MONGO CLIENT:{self.mongo_client}")
-        self.db = self.mongo_client['study_bot_db']
+        self.db = AsyncDatabase(self.mongo_client['study_bot_db'])
+        self.write_buffer = WriteBuffer()
         self.quiz_collection = self.db['quiz_collection']
+        self.quiz_meta_collection = self.db['quiz_meta']
+        self.quiz_bank = QuizBank(self.quiz_collection, self.quiz_meta_collection)
         self.study_times_collection = self.db['study_times']
         self.timers_collection = self.db['timers']
         self.active_quizzes_collection = self.db['active_quizzes']
+        self.active_quizzes = ActiveQuizIndex(self.active_quizzes_collection, self.write_buffer)
         self.user_answers_collection = self.db['user_answers']
+        self.review_schedule_collection = self.db['review_schedule']
+        self.reviews = ReviewScheduler(self.review_schedule_collection, self.quiz_bank, self.write_buffer)
         self.challenge_collection = self.db['challenge']
         self.user_daily_study_time_collection = self.db['user_daily_study_time']
         self.user_levels_collection = self.db['user_levels']
+        self.study_rollups_collection = self.db['study_rollups']
+        self.user_stats_collection = self.db['user_stats']
+        self.user_stats = UserStatsService(self.user_stats_collection, self.write_buffer)
+        self.user_resolver = UserNameResolver(self)
+        self.leaderboards = LeaderboardService(self.study_rollups_collection, self.write_buffer)
+        self.jobs_collection = self.db['jobs']
+        self.bot_meta_collection = self.db['bot_meta']
+        self.leases = LeaseManager(self.db['leases'])
+        self.guild_config_collection = self.db['guild_config']
+        self.guild_config = GuildConfigService(self.guild_config_collection)
+        self.study_history_collection = self.db['study_history']
+        self.study_history = StudyHistory(self.study_history_collection, self.write_buffer)
+        self.sessions = StudySessions(self.study_times_collection, self.study_history,
+                                      self.leaderboards, self.user_stats, self.write_buffer)
+        self.voice_presence = VoicePresence(self.sessions)
+        self.rollover = DailyRollover(self.study_times_collection, self.jobs_collection, self.write_buffer)
+        self.dispatcher = MessageDispatcher(self)
+        self.charts = ChartRenderer()
+        self.command_limiter = UserRateLimiter()
+        self.metrics_server = MetricsServer(port=int(os.getenv('METRICS_PORT'))) if os.getenv('METRICS_PORT') else None
+        METRICS.add_collector('studybot_write_buffer', lambda: dict(self.write_buffer.stats, backlog=self.write_buffer.backlog))
+        METRICS.add_collector('studybot_dispatcher', lambda: dict(self.dispatcher.stats, backlog=self.dispatcher.backlog))
+        METRICS.add_collector('studybot_user_resolver', lambda: self.user_resolver.stats)
+        METRICS.add_collector('studybot_charts', lambda: self.charts.stats)
+        METRICS.add_collector('studybot_voice', lambda: dict(self.voice_presence.stats, backlog=self.voice_presence.backlog,
+                                                             tracked=len(self.voice_presence)))
+        METRICS.add_collector('studybot', lambda: {'open_sessions': len(self.sessions), 'active_quizzes': len(self.active_quizzes),
+                                                   'gateway_latency_seconds': self.latency})
 
     async def on_ready(self):
-        if not self.cogs_added:
-            self.LOG.info(f'We have logged in as {self.user}')
-
-            await self.add_cog(StudyCog(bot, self.study_times_collection, self.timers_collection, self.user_daily_study_time_collection, GUILDS_ID))
-            await self.add_cog(QuizCog(bot,
-                                    self.quiz_collection, self.active_quizzes_collection, self.user_answers_collection))
-            await self.add_cog(ChallengeCog(bot, self.challenge_collection, self.study_times_collection))
-            await self.add_cog(StatsCog(bot, self.study_times_collection, self.user_daily_study_time_collection, self.user_levels_collection, self.user_answers_collection))
-            self.load_quiz()
+        # Also fires on every reconnect, so everything expensive lives in setup_hook
+        if not self.startup_reported:
+            self.startup_reported = True
+            self.startup_timings['ready'] = time.perf_counter() - self.startup_started
+            self.LOG.info(f'We have logged in as {self.user}; startup: ' +
+                          ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.startup_timings.items()))
+            if os.getenv('MONGO_QUERY_AUDIT'):
+                await audit_query_plans(self.db, self.cogs.values())
+
+    @contextlib.asynccontextmanager
+    async def startup_phase(self, phase):
+        started = time.perf_counter()
+        yield
+        self.startup_timings[phase] = time.perf_counter() - started
+
+    async def sync_commands(self):
+        """Sync the slash commands, skipping the API call when their signatures haven't changed since the last sync."""
+        if GUILDS_ID is not None:
             self.tree.copy_global_to(guild=GUILDS_ID)
-            await self.tree.sync(guild=GUILDS_ID)
-            self.cogs_added = True
+        # Extensions load concurrently, so registration order varies between runs and must not change the digest
+        commands_payload = sorted((command.to_dict() for command in self.tree.get_commands(guild=GUILDS_ID)),
+                                  key=lambda payload: (payload['name'], payload.get('type', 1)))
+        digest = hashlib.sha256(json.dumps(commands_payload, sort_keys=True).encode()).hexdigest()
+        meta_id = f"command_tree:{GUILDS_ID.id if GUILDS_ID is not None else 'global'}"
+        meta = await self.bot_meta_collection.find_one({'_id': meta_id})
+        if meta and meta.get('hash') == digest:
+            self.LOG.info("command tree unchanged, skipping sync")
+            return
+        await self.tree.sync(guild=GUILDS_ID)
+        await self.bot_meta_collection.update_one({'_id': meta_id}, {'$set': {'hash': digest}}, upsert=True)
 
-    def load_quiz(self):
-        if self.quiz_collection.count_documents({}) == 0:  # Check if the collection is empty
+    def owns_guild(self, guild_id):
+        """Whether this process runs the shard for `guild_id`; work outside any guild (DMs) belongs to shard 0."""
+        if self.shard_ids is None:
+            return True
+        shard_id = (int(guild_id) >> 22) % self.shard_count if guild_id else 0
+        return shard_id in self.shard_ids
+
+    async def load_quiz(self):
+        # Only one process seeds, so processes starting together don't each upsert the file
+        if not await self.leases.acquire('seed_quizzes', ttl=60):
+            return
+        try:
             with open('quizzes.json', 'r') as f:
                 quizzes = json.load(f)
-                self.quiz_collection.insert_many(quizzes)
+            await self.quiz_bank.seed(quizzes)
+        finally:
+            await self.leases.release('seed_quizzes')
+
+    async def setup_hook(self):
+        try:
+            # Heroku stops dynos with SIGTERM; close cleanly so buffered writes are flushed.
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+        instrument_bot(self)
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        self.dispatcher.start()
+        self.write_buffer.start()
+
+        async with self.startup_phase('indexes'):
+            await apply_indexes(self.db)
+        async with self.startup_phase('services'):
+            await asyncio.gather(
+                self.guild_config.load(),
+                self.leaderboards.load(self, self.study_times_collection, self.leases),
+                self.user_stats.load(self.study_times_collection, self.user_answers_collection,
+                                     self.user_daily_study_time_collection, self.leases),
+                self.study_history.load(self.user_daily_study_time_collection, self.leases),
+                self.load_quiz(),
+            )
+        async with self.startup_phase('extensions'):
+            await asyncio.gather(*(self.load_extension(extension) for extension in EXTENSIONS))
+        if self.owns_guild(None):
+            async with self.startup_phase('command_sync'):
+                await self.sync_commands()
+        self.startup_timings['setup_hook'] = time.perf_counter() - self.startup_started
+
+    async def add_cog(self, cog, **kwargs):
+        instrument_loops(cog)
+        await super().add_cog(cog, **kwargs)
+
+    async def close(self):
+        # Voice changes still inside the debounce window are real; apply them before the write buffer closes
+        await self.voice_presence.flush(force=True)
+        await self.dispatcher.close()
+        self.active_quizzes.close()
+        self.charts.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        # Before super().close(): once the client is marked closed, start() returns and the event loop cancels this
+        # task, so anything still flushing after it would be lost
+        await self.write_buffer.close()
+        await super().close()
+        self.db.close()
+        self.mongo_client.close()
 
     async def on_command_error(self, ctx, error):
-        if isinstance(error, commands.MissingRequiredArgument):
+        if isinstance(error, Throttled):
+            await ctx.send(f"{ctx.message.author.mention} {error}")
+        elif isinstance(error, commands.MissingRequiredArgument):
             await ctx.send(f"{ctx.message.author.mention} {error.param.name} is a required argument that is missing.")
         elif isinstance(error, commands.CommandNotFound):
             # Get the attempted command
@@ -82,6 +225,8 @@ class StudyBot(commands.Bot):
 
 
 if __name__ == "__main__":
-    bot = StudyBot(command_prefix='!', intents=discord.Intents.all())
+    bot = StudyBot(command_prefix='!', intents=discord.Intents.all(), shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
     bot.help_command = CustomHelpCommand()
-    bot.run(os.getenv('DISCORD_BOT_TOKEN'))
+    # discord.py's own records go through the same queue instead of its default blocking stream handler
+    setup_logger('discord')
+    bot.run(os.getenv('DISCORD_BOT_TOKEN'), log_handler=None)
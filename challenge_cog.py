@@ -1,13 +1,21 @@
+import asyncio
 import datetime
+import time
 import uuid
 from abc import ABC
 from typing import List
 
 import discord
 from discord import app_commands
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.ext.commands import hybrid_command
 
+from logger_config import setup_logger
+from metrics import JOB_SECONDS
+from scheduler import DeadlineScheduler
+
+CHALLENGE_RETRY_SECONDS = 60
+
 
 
 async def send_message_to_challenge_channel(channel, duration, members):
@@ -82,11 +90,17 @@ class MemberListTransformer(app_commands.Transformer, ABC):
 
 
 class ChallengeCog(commands.Cog, name="Challenge Commands"):
-    def __init__(self, bot, challenge_collection, study_times_collection):
+    LOG = setup_logger("ChallengeCog")
+    QUERY_SHAPES = [
+        ('challenge', {'participants': {'$in': [0]}}, None),
+    ]
+
+    def __init__(self, bot, challenge_collection, sessions, dispatcher):
         self.bot = bot
+        self.dispatcher = dispatcher
         self.challenge_collection = challenge_collection
-        self.study_times_collection = study_times_collection
-        self.check_challenges.start()
+        self.sessions = sessions
+        self.finalizer = DeadlineScheduler("ChallengeFinalizer")
         self.converter = commands.MemberConverter()
 
     @hybrid_command(aliases=["sc"],
@@ -98,14 +112,17 @@ class ChallengeCog(commands.Cog, name="Challenge Commands"):
             duration: int,
             members: app_commands.Transform[MemberList, MemberListTransformer]):
 
-        discord_member_list = []
-        for member_id in members.member_list:
-            member = await self.converter.convert(ctx, member_id)
-            discord_member_list.append(member)
-            print(f"member: {member} type:{type(member)}")
-            if self.challenge_collection.find_one({"participants": member.id}):
-                await ctx.send(f"{member.mention} is already in a study challenge.")
-                return
+        started = time.perf_counter()
+        resolved = await asyncio.gather(*(self.converter.convert(ctx, member_id) for member_id in members.member_list))
+        discord_member_list = list({member.id: member for member in resolved}.values())
+        busy = await self.challenge_collection.find(
+            {"participants": {"$in": [member.id for member in discord_member_list]}}, {"participants": 1})
+        busy_ids = {user_id for challenge in busy for user_id in challenge["participants"]}
+        busy_members = [member for member in discord_member_list if member.id in busy_ids]
+        if busy_members:
+            await ctx.send(f"{', '.join(member.mention for member in busy_members)} "
+                           f"{'is' if len(busy_members) == 1 else 'are'} already in a study challenge.")
+            return
 
         # Create a new text channel
         channel_name = "study-challenge-" + str(uuid.uuid4())
@@ -117,72 +134,118 @@ class ChallengeCog(commands.Cog, name="Challenge Commands"):
             overwrites[member] = discord.PermissionOverwrite(read_messages=True)
         channel = await ctx.guild.create_text_channel(channel_name, overwrites=overwrites)
 
-        # Send an invitation to the channel for each member
+        # Invitations are queued on the dispatcher; check-ins and both announcements run concurrently
         invite = await channel.create_invite()
-        for member in discord_member_list:
-            if member.bot:
-                continue
-            await member.send(f"You've been invited to a study challenge! Join here: {invite.url}")
-            await self.auto_check_in_participants(ctx, member)
-
-        message = await send_message_to_original_channel(ctx, channel, duration, discord_member_list)
-        await send_message_to_challenge_channel(channel, duration, discord_member_list)
+        humans = [member for member in discord_member_list if not member.bot]
+        for member in humans:
+            self.dispatcher.send(member, f"You've been invited to a study challenge! Join here: {invite.url}")
+        message, *_ = await asyncio.gather(
+            send_message_to_original_channel(ctx, channel, duration, discord_member_list),
+            send_message_to_challenge_channel(channel, duration, discord_member_list),
+            *(self.sessions.check_in(str(member.id), str(ctx.channel.id)) for member in humans)
+        )
 
         await self.update_challenge_in_db(channel, ctx, duration, discord_member_list, message)
-
-    async def auto_check_in_participants(self, ctx, member):
-        new_ctx = await self.bot.get_context(ctx.message)
-        new_ctx.message.author = member
-        new_ctx.study_times_collection = self.study_times_collection
-        await self.bot.get_command("check_in").callback(self, new_ctx)
+        self.LOG.info(f"challenge for {len(discord_member_list)} members set up in "
+                      f"{(time.perf_counter() - started) * 1000:.0f}ms")
 
     async def update_challenge_in_db(self, channel, ctx, duration, members, message):
         # Save the challenge details to MongoDB
         end_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=duration)
         challenge = {
+            "guild_id": ctx.guild.id,
             "channel_id": channel.id,
             "message_id": message.id,
             "original_channel_id": ctx.channel.id,
             "end_time": end_time,
             "participants": [member.id for member in members],  # Save the user IDs of the participants
         }
-        self.challenge_collection.insert_one(challenge)
-
-    @tasks.loop(minutes=1)
-    async def check_challenges(self, ):
-        # Check MongoDB for any channels that should be deleted
-        now = datetime.datetime.utcnow()
-        expired_challenges = self.challenge_collection.find({"end_time": {"$lt": now}})
-        for challenge in expired_challenges:
-            channel = self.bot.get_channel(challenge["channel_id"])
-            if "original_channel_id" not in challenge:
-                await channel.delete(reason="Study challenge has ended.")
-                self.challenge_collection.delete_one({"_id": challenge["_id"]})
-                continue
-            original_channel = self.bot.get_channel(challenge["original_channel_id"])
-            if channel and original_channel:
-                try:
-                    # Fetch the original message from the original channel
-                    message = await original_channel.fetch_message(challenge["message_id"])
-                except discord.errors.NotFound:
-                    # Message doesn't exist, continue with the next challenge
-                    continue
-
-                await update_challenge_complete(challenge, message)
-
-                # Delete the study challenge channel
-                await channel.delete(reason="Study challenge has ended.")
-                self.challenge_collection.delete_one({"_id": challenge["_id"]})
-
-                await self.auto_check_out_participants(challenge, channel, message, original_channel)
-
-    async def auto_check_out_participants(self, challenge, channel, message, original_channel):
-        if channel and original_channel:
-            # Automatically check out the participants
-            for user_id in challenge["participants"]:
-                member = self.bot.get_guild(channel.guild.id).get_member(user_id)
-                if member and not member.bot:
-                    new_ctx = await self.bot.get_context(message)
-                    new_ctx.message.author = member
-                    new_ctx.study_times_collection = self.study_times_collection
-                    await self.bot.get_command("check_out").callback(self, new_ctx)
+        await self.challenge_collection.insert_one(challenge)
+        self.schedule_challenge(challenge)
+
+    async def cog_load(self):
+        self.finalizer.start()
+        # Challenges this process owns, including any whose finalization was cut short by a restart. This runs
+        # before the gateway is ready, so ownership comes from the shard ids rather than the guild cache; challenges
+        # saved before guild_id was recorded are left to shard 0.
+        challenges = [challenge for challenge in await self.challenge_collection.find()
+                      if self.bot.owns_guild(challenge.get("guild_id"))]
+        for challenge in challenges:
+            self.schedule_challenge(challenge)
+        self.LOG.info(f"scheduled {len(challenges)} challenges")
+
+    def cog_unload(self):
+        self.finalizer.stop()
+
+    def schedule_challenge(self, challenge, deadline=None):
+        if deadline is None:
+            deadline = challenge["end_time"].replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.finalizer.schedule(challenge["_id"], deadline, lambda: self.finalize_when_ready(challenge))
+
+    async def finalize_when_ready(self, challenge):
+        # Challenges that ended while the bot was down fire as soon as cog_load schedules them, which is before the
+        # gateway cache is filled and possibly before StudyCog has rehydrated the open sessions
+        await self.bot.wait_until_ready()
+        await self.sessions.wait_loaded()
+        await self.finalize_challenge(challenge)
+
+    @JOB_SECONDS.time(job='challenge_finalize')
+    async def finalize_challenge(self, challenge):
+        """End a challenge: check out its participants as of the end time, close the announcement and the channel.
+
+        Every step is safe to repeat and the challenge document is deleted last, so a crash or a failed step only
+        means the whole finalization runs again (on retry or on the next start).
+        """
+        try:
+            original_channel_id = challenge.get("original_channel_id")
+            if original_channel_id is not None:
+                end_time = challenge["end_time"].replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+                guild_id = challenge.get("guild_id")
+                await self.sessions.check_out_many(
+                    [str(user_id) for user_id in challenge["participants"]], str(original_channel_id),
+                    str(guild_id) if guild_id else None, end_time)
+            await asyncio.gather(self.close_announcement(challenge), self.delete_challenge_channel(challenge))
+            await self.challenge_collection.delete_one({"_id": challenge["_id"]})
+        except Exception as e:
+            self.LOG.error(f"finalizing challenge {challenge['_id']} failed, retrying in {CHALLENGE_RETRY_SECONDS}s: {e!r}")
+            self.schedule_challenge(challenge, time.time() + CHALLENGE_RETRY_SECONDS)
+
+    async def resolve_channel(self, channel_id):
+        """The channel with this id, or None if Discord says it no longer exists.
+
+        A cache miss alone does not mean the channel is gone (its guild may be unavailable), so it falls back to
+        fetching the channel; any error other than NotFound propagates and the finalization is retried.
+        """
+        channel = self.bot.get_channel(channel_id)
+        if channel is not None:
+            return channel
+        try:
+            return await self.bot.fetch_channel(channel_id)
+        except discord.errors.NotFound:
+            return None
+
+    async def close_announcement(self, challenge):
+        original_channel_id = challenge.get("original_channel_id")
+        if original_channel_id is None:
+            return
+        original_channel = await self.resolve_channel(original_channel_id)
+        if original_channel is None:
+            return
+        try:
+            message = await original_channel.fetch_message(challenge["message_id"])
+        except discord.errors.NotFound:
+            return
+        await update_challenge_complete(challenge, message)
+
+    async def delete_challenge_channel(self, challenge):
+        channel = await self.resolve_channel(challenge["channel_id"])
+        if channel is None:
+            return
+        try:
+            await channel.delete(reason="Study challenge has ended.")
+        except discord.errors.NotFound:
+            pass
+
+
+async def setup(bot):
+    await bot.add_cog(ChallengeCog(bot, bot.challenge_collection, bot.sessions, bot.dispatcher))
@@ -0,0 +1,84 @@
+import asyncio
+import io
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from logger_config import setup_logger
+
+CHART_WORKERS = 2
+CHART_CACHE_SIZE = 256
+
+
+def render_history_chart(title, daily, weekly, monthly):
+    """Render the three study-time series (lists of (label, hours)) as one PNG; runs in a worker process."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(3, 1, figsize=(8, 9))
+    for axis, (name, series) in zip(axes, (("Last 30 days", daily), ("Last 12 weeks", weekly),
+                                           ("Last 12 months", monthly))):
+        labels = [label for label, _ in series]
+        axis.bar(range(len(series)), [hours for _, hours in series], color='#78C2C4')
+        axis.set_title(name)
+        axis.set_ylabel("hours")
+        step = max(len(labels) // 10, 1)
+        axis.set_xticks(range(0, len(labels), step))
+        axis.set_xticklabels(labels[::step], rotation=45, ha='right', fontsize=8)
+    figure.suptitle(title)
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', dpi=80)
+    plt.close(figure)
+    return buffer.getvalue()
+
+
+class ChartRenderer:
+    """Renders charts in a process pool, so matplotlib never runs on the gateway loop, and caches the PNGs.
+
+    Renders are keyed by their input data, so a cached chart stays valid until the underlying numbers change.
+    Concurrent requests for the same chart share a single render. Arguments must be hashable and picklable.
+    """
+    LOG = setup_logger("ChartRenderer")
+
+    def __init__(self, workers=CHART_WORKERS, cache_size=CHART_CACHE_SIZE):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._pool = None
+        self._cache = OrderedDict()
+        self._rendering = {}
+        self.stats = {'renders': 0, 'cache_hits': 0, 'errors': 0}
+
+    async def render(self, function, *args):
+        key = (function.__name__, args)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.stats['cache_hits'] += 1
+            return self._cache[key]
+        if key not in self._rendering:
+            self._rendering[key] = asyncio.ensure_future(self._render(key, function, args))
+        return await asyncio.shield(self._rendering[key])
+
+    async def _render(self, key, function, args):
+        if self._pool is None:
+            # spawn: forking a process that runs executor threads can deadlock the child
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            png = await asyncio.get_running_loop().run_in_executor(self._pool, function, *args)
+        except Exception as e:
+            self.LOG.error(f"{function.__name__} failed: {e!r}")
+            self.stats['errors'] += 1
+            raise
+        finally:
+            del self._rendering[key]
+        self.stats['renders'] += 1
+        self._cache[key] = png
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return png
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,146 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+import discord
+
+from logger_config import setup_logger
+
+MESSAGE_LIMIT = 2000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class MessageDispatcher:
+    """Central outbound DM queue drained by a pool of workers.
+
+    Messages are queued per recipient, so one recipient (one DM route) is only ever served by one worker at a time and
+    is spaced by `route_interval`. All workers share a global token bucket kept under Discord's global rate limit.
+    Plain-text messages still waiting for the same recipient are coalesced into one message. Rate-limit and server
+    errors are retried with exponential backoff; any other failure is logged and counted without affecting the rest
+    of the queue.
+    """
+    LOG = setup_logger("MessageDispatcher")
+
+    def __init__(self, bot, workers=8, global_rate=40, route_interval=0.5, max_retries=3):
+        self.bot = bot
+        self.workers = workers
+        self.route_interval = route_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._queue = asyncio.Queue()
+        self._pending = {}
+        self._in_flight = set()
+        self._route_ready_at = {}
+        self._tasks = []
+        self._started_at = None
+        self.stats = {'queued': 0, 'coalesced': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+
+    def start(self):
+        if not self._tasks:
+            self._started_at = time.monotonic()
+            self._tasks = [asyncio.create_task(self._worker(), name=f"dm-worker-{i}") for i in range(self.workers)]
+
+    async def close(self, timeout=10):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.LOG.warning(f"closing with {self.backlog} undelivered messages")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    @property
+    def backlog(self):
+        return sum(len(messages) for messages in self._pending.values())
+
+    def throughput(self):
+        if self._started_at is None:
+            return 0.0
+        return self.stats['sent'] / max(time.monotonic() - self._started_at, 1e-9)
+
+    def send(self, recipient, content=None, embed=None):
+        """Queue a DM to a User/Member (or user id) without waiting for it to be delivered."""
+        key = recipient if isinstance(recipient, int) else recipient.id
+        self.stats['queued'] += 1
+        messages = self._pending.get(key)
+        if messages is None:
+            messages = self._pending[key] = deque()
+            if key not in self._in_flight:
+                self._queue.put_nowait(key)
+        last = messages[-1] if messages else None
+        if (embed is None and last is not None and last['embed'] is None and content
+                and len(last['content']) + len(content) + 1 <= MESSAGE_LIMIT):
+            last['content'] += "\n" + content
+            self.stats['coalesced'] += 1
+        else:
+            messages.append({'recipient': recipient, 'content': content, 'embed': embed})
+
+    async def drain(self):
+        """Wait until every queued message has been delivered or given up on."""
+        await self._queue.join()
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            self._in_flight.add(key)
+            try:
+                messages = self._pending.pop(key, deque())
+                while messages:
+                    await self._deliver(key, messages.popleft())
+            finally:
+                self._in_flight.discard(key)
+                if key in self._pending:
+                    self._queue.put_nowait(key)
+                else:
+                    self._route_ready_at.pop(key, None)
+                self._queue.task_done()
+
+    async def _resolve(self, recipient):
+        if not isinstance(recipient, int):
+            return recipient
+        return self.bot.get_user(recipient) or await self.bot.fetch_user(recipient)
+
+    async def _deliver(self, key, message):
+        for attempt in range(self.max_retries + 1):
+            delay = self._route_ready_at.get(key, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._bucket.acquire()
+            self._route_ready_at[key] = time.monotonic() + self.route_interval
+            try:
+                recipient = await self._resolve(message['recipient'])
+                await recipient.send(content=message['content'], embed=message['embed'])
+                self.stats['sent'] += 1
+                return
+            except discord.HTTPException as e:
+                retryable = e.status == 429 or e.status >= 500
+                if not retryable or attempt == self.max_retries:
+                    self.stats['failed'] += 1
+                    self.LOG.warning(f"could not DM {key}: {e}")
+                    return
+                self.stats['retried'] += 1
+                await asyncio.sleep(2 ** attempt + random.random())
+            except Exception:
+                self.stats['failed'] += 1
+                self.LOG.exception(f"could not DM {key}")
+                return
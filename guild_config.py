@@ -0,0 +1,39 @@
+from logger_config import setup_logger
+
+
+class GuildConfigService:
+    """Per-guild settings from the `guild_config` collection, cached in memory (one document per guild)."""
+    LOG = setup_logger("GuildConfigService")
+
+    def __init__(self, guild_config_collection):
+        self.guild_config_collection = guild_config_collection
+        self._configs = {}
+
+    async def load(self):
+        self._configs = {config['guild_id']: config for config in await self.guild_config_collection.find()}
+        self.LOG.info(f"loaded configuration for {len(self._configs)} guilds")
+
+    def get(self, guild_id):
+        return self._configs.get(guild_id, {})
+
+    def quiz_channel_ids(self, guild_id):
+        return self.get(guild_id).get('quiz_channel_ids', [])
+
+    def study_voice_channel_ids(self, guild_id):
+        return self.get(guild_id).get('study_voice_channel_ids', [])
+
+    async def toggle_list_value(self, guild_id, field, value):
+        """Add `value` to the list `field` of a guild's config, or remove it if present; returns True if added."""
+        config = self._configs.setdefault(guild_id, {'guild_id': guild_id})
+        values = config.setdefault(field, [])
+        added = value not in values
+        if added:
+            values.append(value)
+        else:
+            values.remove(value)
+        await self.guild_config_collection.update_one(
+            {'guild_id': guild_id},
+            {'$addToSet' if added else '$pull': {field: value}},
+            upsert=True
+        )
+        return added
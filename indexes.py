@@ -0,0 +1,100 @@
+import asyncio
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from logger_config import setup_logger
+
+LOG = setup_logger("Indexes")
+
+ACTIVE_QUIZ_TTL_SECONDS = 12 * 60 * 60
+
+# Declarative index registry: collection name -> indexes the cogs' queries rely on.
+INDEXES = {
+    'study_times': [
+        IndexModel([('user_id', ASCENDING), ('channel_id', ASCENDING)], name='user_channel'),
+        # Only users who studied today are indexed, so the midnight rollover reads exactly the rows it resets.
+        IndexModel([('daily_study_time', ASCENDING)], name='active_today',
+                   partialFilterExpression={'daily_study_time': {'$gt': 0}}),
+        # Open sessions only, for rehydrating the session cache on startup.
+        IndexModel([('check_in_time', ASCENDING)], name='open_sessions',
+                   partialFilterExpression={'check_in_time': {'$exists': True}}),
+    ],
+    'study_rollups': [
+        IndexModel([('scope', ASCENDING), ('user_id', ASCENDING)], name='scope_user', unique=True),
+    ],
+    'timers': [
+        IndexModel([('user_id', ASCENDING)], name='user'),
+    ],
+    'active_quizzes': [
+        IndexModel([('message_id', ASCENDING)], name='message'),
+        # Replaces the old minute-level sweep: mongod removes quizzes 12 hours after start_time (UTC).
+        IndexModel([('start_time', ASCENDING)], name='start_time_ttl', expireAfterSeconds=ACTIVE_QUIZ_TTL_SECONDS),
+    ],
+    'user_answers': [
+        IndexModel([('user_id', ASCENDING)], name='user'),
+    ],
+    'review_schedule': [
+        IndexModel([('user_id', ASCENDING), ('quiz_id', ASCENDING)], name='user_quiz', unique=True),
+        # Next reviews for a user, most overdue first, as an index range read.
+        IndexModel([('user_id', ASCENDING), ('due', ASCENDING)], name='user_due'),
+    ],
+    'challenge': [
+        IndexModel([('participants', ASCENDING)], name='participants'),
+    ],
+    'quiz_collection': [
+        IndexModel([('question', ASCENDING)], name='question'),
+    ],
+    'user_daily_study_time': [
+        IndexModel([('user_id', ASCENDING), ('date', ASCENDING)], name='user_date'),
+    ],
+    'study_history': [
+        IndexModel([('user_id', ASCENDING), ('month', ASCENDING)], name='user_month', unique=True),
+    ],
+    'user_stats': [
+        IndexModel([('user_id', ASCENDING)], name='user', unique=True),
+    ],
+    'guild_config': [
+        IndexModel([('guild_id', ASCENDING)], name='guild', unique=True),
+    ],
+    'user_levels': [
+        IndexModel([('user_id', ASCENDING)], name='user'),
+    ],
+}
+
+
+async def apply_indexes(db, registry=INDEXES):
+    """Create every registered index. Safe to call on every start: existing identical indexes are a no-op."""
+    async def ensure(collection_name, indexes):
+        try:
+            names = await db[collection_name].create_indexes(indexes)
+            LOG.info(f"ensured indexes on {collection_name}: {names}")
+        except OperationFailure as e:
+            # An index with the same name/keys but different options already exists; leave it for a manual fix.
+            LOG.error(f"failed to ensure indexes on {collection_name}: {e}")
+
+    await asyncio.gather(*(ensure(collection_name, indexes) for collection_name, indexes in registry.items()))
+
+
+def _plan_stages(plan):
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from _plan_stages(child)
+
+
+async def audit_query_plans(db, cogs):
+    """Explain each cog's declared QUERY_SHAPES and report the ones that fall back to a collection scan."""
+    collscans = []
+    for cog in cogs:
+        for collection_name, query, sort in getattr(cog, 'QUERY_SHAPES', []):
+            explain = await db[collection_name].explain(query, sort=sort)
+            stages = set(_plan_stages(explain['queryPlanner']['winningPlan']))
+            if 'COLLSCAN' in stages:
+                collscans.append((cog.qualified_name, collection_name, query, sort))
+                LOG.warning(f"COLLSCAN in {cog.qualified_name}: {collection_name}.find({query}) sort={sort}")
+            else:
+                LOG.info(f"{cog.qualified_name}: {collection_name}.find({query}) uses {sorted(filter(None, stages))}")
+    return collscans
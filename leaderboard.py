@@ -0,0 +1,144 @@
+import asyncio
+import itertools
+from bisect import bisect_left, insort
+
+import discord
+from pymongo import UpdateOne
+
+from logger_config import setup_logger
+
+
+def channel_scope(channel_id):
+    return f"channel:{channel_id}"
+
+
+def guild_scope(guild_id):
+    return f"guild:{guild_id}"
+
+
+_versions = itertools.count(1)
+
+
+class RankedBoard:
+    """Per-user totals kept sorted by (-total, user_id), so rank lookups are a binary search.
+
+    `version` changes on every update and is unique across boards, so it can key cached renders of a board.
+    """
+
+    def __init__(self):
+        self._order = []
+        self._totals = {}
+        self.version = next(_versions)
+
+    def __len__(self):
+        return len(self._totals)
+
+    def add(self, user_id, study_time):
+        old = self._totals.get(user_id)
+        if old is not None:
+            del self._order[bisect_left(self._order, (-old, user_id))]
+        total = (old or 0) + study_time
+        self._totals[user_id] = total
+        insort(self._order, (-total, user_id))
+        self.version = next(_versions)
+
+    def rank(self, user_id):
+        """1-based position of `user_id`, or None if they have no study time in this scope."""
+        total = self._totals.get(user_id)
+        if total is None:
+            return None
+        return bisect_left(self._order, (-total, user_id)) + 1
+
+    def total(self, user_id):
+        return self._totals.get(user_id, 0)
+
+    def top(self, n):
+        return [(user_id, -negative_total) for negative_total, user_id in self._order[:n]]
+
+
+class LeaderboardService:
+    """Materialized per-channel and per-guild rankings backed by the `study_rollups` collection.
+
+    Each rollup document holds one user's summed study time in one scope (`channel:<id>` or `guild:<id>`).
+    All boards are loaded once at startup and then updated incrementally on every check-out; memory is updated
+    immediately and the rollup increments go through the write buffer.
+    """
+    LOG = setup_logger("LeaderboardService")
+
+    def __init__(self, rollup_collection, write_buffer):
+        self.rollup_collection = rollup_collection
+        self.write_buffer = write_buffer
+        self._boards = {}
+
+    def board(self, scope):
+        if scope not in self._boards:
+            self._boards[scope] = RankedBoard()
+        return self._boards[scope]
+
+    async def load(self, bot, study_times_collection, leases):
+        # Runs from setup_hook, before any check-out can add to the boards or queue an $inc the backfill would overwrite;
+        # one process backfills while the others wait for it, so no process starts with half-built boards
+        await leases.run_once('backfill_study_rollups', self._has_rollups,
+                              lambda: self.backfill(bot, study_times_collection))
+        await self._load_rollups()
+
+    async def _has_rollups(self):
+        return await self.rollup_collection.count_documents({}, limit=1) > 0
+
+    async def _load_rollups(self):
+        rollups = await self.rollup_collection.find({}, {'_id': 0, 'scope': 1, 'user_id': 1, 'total_study_time': 1})
+        for rollup in rollups:
+            self.board(rollup['scope']).add(rollup['user_id'], rollup.get('total_study_time', 0))
+        self.LOG.info(f"loaded {len(rollups)} rollups into {len(self._boards)} leaderboards")
+
+    async def backfill(self, bot, study_times_collection):
+        """Build the rollups once from the per-channel study_times documents.
+
+        Check-outs record the guild on the document; channels of documents written before that are resolved once.
+        """
+        totals = {}
+        documents = await study_times_collection.find({'total_study_time': {'$gt': 0}})
+        guild_ids = await self._resolve_guilds(bot, {user_data['channel_id'] for user_data in documents
+                                                     if user_data.get('guild_id') is None})
+        for user_data in documents:
+            user_id, channel_id = user_data['user_id'], user_data['channel_id']
+            scopes = [channel_scope(channel_id)]
+            guild_id = user_data.get('guild_id') or guild_ids.get(channel_id)
+            if guild_id is not None:
+                scopes.append(guild_scope(guild_id))
+            for scope in scopes:
+                totals[(scope, user_id)] = totals.get((scope, user_id), 0) + user_data['total_study_time']
+        if totals:
+            await self.rollup_collection.bulk_write([
+                UpdateOne({'scope': scope, 'user_id': user_id}, {'$set': {'total_study_time': total}}, upsert=True)
+                for (scope, user_id), total in totals.items()
+            ])
+        self.LOG.info(f"backfilled {len(totals)} leaderboard rollups from study_times")
+
+    async def _resolve_guilds(self, bot, channel_ids):
+        """Map channel ids to guild ids (None for DMs and deleted channels), through REST where the cache is empty.
+
+        The backfill runs before the gateway has connected, so the cache is usually empty.
+        """
+        async def resolve(channel_id):
+            channel = bot.get_channel(int(channel_id))
+            if channel is None:
+                try:
+                    channel = await bot.fetch_channel(int(channel_id))
+                except discord.HTTPException as e:
+                    self.LOG.warning(f"channel {channel_id} could not be resolved, backfilling its channel board only: {e}")
+                    return None
+            guild = getattr(channel, 'guild', None)
+            return guild.id if guild is not None else None
+
+        channel_ids = list(channel_ids)
+        return dict(zip(channel_ids, await asyncio.gather(*(resolve(channel_id) for channel_id in channel_ids))))
+
+    def add_study_time(self, user_id, channel_id, guild_id, study_time):
+        scopes = [channel_scope(channel_id)]
+        if guild_id is not None:
+            scopes.append(guild_scope(guild_id))
+        for scope in scopes:
+            self.write_buffer.add(self.rollup_collection, UpdateOne(
+                {'scope': scope, 'user_id': user_id}, {'$inc': {'total_study_time': study_time}}, upsert=True))
+            self.board(scope).add(user_id, study_time)
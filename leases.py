@@ -0,0 +1,56 @@
+import asyncio
+import datetime
+import os
+import socket
+
+from pymongo.errors import DuplicateKeyError
+
+from logger_config import setup_logger
+
+ONCE_LEASE_SECONDS = 600
+ONCE_POLL_SECONDS = 2
+
+
+class LeaseManager:
+    """Named, expiring locks in the `leases` collection, so a cluster-wide job runs in one process at a time.
+
+    A lease is one document `{_id: name, owner, expires_at}`. Acquiring is a single upsert that only matches when the
+    lease is free, expired or already ours; if another process holds it the upsert collides on `_id` and we lose.
+    A crashed holder blocks the job for at most `ttl` seconds.
+    """
+    LOG = setup_logger("LeaseManager")
+
+    def __init__(self, leases_collection, owner=None):
+        self.leases_collection = leases_collection
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+
+    async def acquire(self, name, ttl):
+        now = datetime.datetime.utcnow()
+        try:
+            await self.leases_collection.update_one(
+                {'_id': name, '$or': [{'expires_at': {'$lte': now}}, {'owner': self.owner}]},
+                {'$set': {'owner': self.owner, 'expires_at': now + datetime.timedelta(seconds=ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            self.LOG.info(f"lease {name} is held by another process")
+            return False
+        return True
+
+    async def release(self, name):
+        await self.leases_collection.delete_one({'_id': name, 'owner': self.owner})
+
+    async def run_once(self, name, is_done, job, ttl=ONCE_LEASE_SECONDS):
+        """Run `job()` in one process of the cluster unless `await is_done()`; the others wait for it to finish.
+
+        Returns True if this process ran the job. A holder that crashes is replaced once its lease expires.
+        """
+        while not await is_done():
+            if await self.acquire(name, ttl):
+                try:
+                    await job()
+                finally:
+                    await self.release(name)
+                return True
+            await asyncio.sleep(ONCE_POLL_SECONDS)
+        return False
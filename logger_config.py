@@ -1,21 +1,50 @@
-
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import colorlog
 
+# LOG_LEVEL sets the default level; LOG_LEVELS overrides it per logger, e.g. "QuizCog=DEBUG,WriteBuffer=WARNING".
+# LOG_FORMAT=json writes one JSON object per line to both the console and the log file.
+DEFAULT_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LEVEL_OVERRIDES = dict(
+    (name.strip(), level.strip().upper())
+    for name, level in (item.split('=', 1) for item in os.getenv('LOG_LEVELS', '').split(',') if '=' in item)
+)
+JSON_LOGS = os.getenv('LOG_FORMAT', '').lower() == 'json'
+
+_queue_handler = None
+_listener = None
 
-def setup_logger(logger_name):
-    # Create a logger with the specified name
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
 
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def _build_handlers():
     # Create a file handler that logs debug and higher level messages to a file
     file_handler = RotatingFileHandler("discord_study_bot.log", maxBytes=10 ** 6, backupCount=5)
 
     # Create a stream handler that logs debug and higher level messages to the console
     stream_handler = colorlog.StreamHandler()
 
+    if JSON_LOGS:
+        file_handler.setFormatter(JsonFormatter())
+        stream_handler.setFormatter(JsonFormatter())
+        return file_handler, stream_handler
+
     # Create a formatter and add it to the handlers
     file_formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
     file_handler.setFormatter(file_formatter)
@@ -49,9 +78,35 @@ def setup_logger(logger_name):
         style="%",
     )
     stream_handler.setFormatter(color_formatter)
+    return file_handler, stream_handler
 
-    # Add the handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
 
+def _shared_queue_handler():
+    """The one QueueHandler every logger writes to; a background thread formats records and does the file/console I/O."""
+    global _queue_handler, _listener
+    if _queue_handler is None:
+        log_queue = queue.SimpleQueue()
+        _queue_handler = QueueHandler(log_queue)
+        _listener = QueueListener(log_queue, *_build_handlers(), respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+    return _queue_handler
+
+
+def shutdown_logging():
+    """Stop the listener thread after it has written every queued record."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def setup_logger(logger_name):
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(LEVEL_OVERRIDES.get(logger_name, DEFAULT_LEVEL))
+    handler = _shared_queue_handler()
+    # Loggers are set up once per class or module, but scheduler instances and re-imports can ask again
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    logger.propagate = False
     return logger
@@ -0,0 +1,255 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+import discord
+from aiohttp import web
+from discord.ext import tasks
+from pymongo import monitoring
+
+from logger_config import setup_logger
+
+LOG = setup_logger("Metrics")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(key)} {value}" for key, value in values)
+        return lines
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram per label set, plus the maximum seen (for `!perf`)."""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series['buckets'][index] += 1
+            series['count'] += 1
+            series['sum'] += value
+            series['max'] = max(series['max'], value)
+
+    def time(self, **labels):
+        """Decorator recording how long each call of a coroutine function takes."""
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def quantile(self, series, q):
+        """Upper bucket bound below which a fraction `q` of the observations fall (the max if past the last bucket)."""
+        target, seen = q * series['count'], 0
+        for bound, count in zip(self.buckets, series['buckets']):
+            seen += count
+            if seen >= target:
+                return min(bound, series['max'])
+        return series['max']
+
+    def summary(self):
+        """Return [(labels dict, count, mean, p95, max)] for every label set."""
+        with self._lock:
+            snapshot = [(dict(key), dict(series)) for key, series in self._series.items()]
+        return [(labels, series['count'], series['sum'] / series['count'], self.quantile(series, 0.95), series['max'])
+                for labels, series in snapshot if series['count']]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation):
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix, collect):
+        """Export the numeric values of the dict returned by `collect()` as gauges named `<prefix>_<key>`."""
+        self._collectors.append((prefix, collect))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, collect in self._collectors:
+            for key, value in collect().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+COMMAND_SECONDS = METRICS.histogram('studybot_command_seconds', "Command latency by command and outcome.")
+MONGO_SECONDS = METRICS.histogram('studybot_mongo_seconds', "MongoDB command latency by command and collection.")
+DISCORD_REST_SECONDS = METRICS.histogram('studybot_discord_rest_seconds', "Discord REST latency by route.")
+LOOP_SECONDS = METRICS.histogram('studybot_loop_seconds', "Duration of background loop iterations.")
+LOOP_DRIFT_SECONDS = METRICS.histogram('studybot_loop_drift_seconds',
+                                       "How late background loop iterations start against their schedule.")
+JOB_SECONDS = METRICS.histogram('studybot_job_seconds', "Duration of scheduled jobs (rollover, challenge finalization).")
+MONGO_FAILURES = METRICS.counter('studybot_mongo_failures_total', "Failed MongoDB commands by command.")
+COMMAND_CACHE_REQUESTS = METRICS.counter('studybot_command_cache_requests_total',
+                                         "Cached command lookups by cache and result (hit, coalesced, miss).")
+THROTTLED_COMMANDS = METRICS.counter('studybot_throttled_commands_total',
+                                     "Commands rejected by the per-user rate limit, by command.")
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records every MongoDB command's server round-trip time; pass it to `MongoClient(event_listeners=[...])`."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name,
+                              collection=self._collections.pop(event.request_id, ""))
+
+    def failed(self, event):
+        self._collections.pop(event.request_id, None)
+        MONGO_FAILURES.inc(command=event.command_name)
+
+
+async def _before_command(ctx):
+    ctx.metrics_started = time.perf_counter()
+
+
+async def _after_command(ctx):
+    started = getattr(ctx, 'metrics_started', None)
+    if started is not None:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, command=ctx.command.qualified_name,
+                                status='error' if ctx.command_failed else 'ok')
+
+
+def instrument_bot(bot):
+    """Time every command (prefix and slash, through the bot-wide invoke hooks) and every Discord REST call."""
+    bot.before_invoke(_before_command)
+    bot.after_invoke(_after_command)
+    request = bot.http.request
+
+    async def timed_request(route, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            DISCORD_REST_SECONDS.observe(time.perf_counter() - started, route=f"{route.method} {route.path}")
+
+    bot.http.request = timed_request
+
+
+def instrument_loops(cog):
+    """Time every `tasks.loop` of a cog and record how late each iteration starts."""
+    for name, attribute in type(cog).__dict__.items():
+        if not isinstance(attribute, tasks.Loop):
+            continue
+        loop = getattr(cog, name)  # the per-instance copy the cog starts
+        coro = loop.coro
+        label = f"{type(cog).__name__}.{name}"
+
+        def make_timed(loop, coro, label):
+            @functools.wraps(coro)
+            async def timed(*args, **kwargs):
+                scheduled = getattr(loop, '_last_iteration', None)
+                if scheduled is not None:
+                    LOOP_DRIFT_SECONDS.observe(max((discord.utils.utcnow() - scheduled).total_seconds(), 0), loop=label)
+                started = time.perf_counter()
+                try:
+                    return await coro(*args, **kwargs)
+                finally:
+                    LOOP_SECONDS.observe(time.perf_counter() - started, loop=label)
+            return timed
+
+        loop.coro = make_timed(loop, coro, label)
+
+
+class MetricsServer:
+    """Serves the registry in the Prometheus text format on `http://<host>:<port>/metrics`."""
+
+    def __init__(self, registry=METRICS, host='127.0.0.1', port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        LOG.info(f"serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def handle(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
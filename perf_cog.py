@@ -0,0 +1,44 @@
+import discord
+from discord.ext import commands
+from discord.ext.commands import hybrid_command, is_owner
+
+from metrics import COMMAND_SECONDS, DISCORD_REST_SECONDS, LOOP_DRIFT_SECONDS, LOOP_SECONDS, MONGO_SECONDS
+
+EMBED_COLOR = 0X78C2C4
+PERF_TOP_N = 5
+
+
+def slowest(histogram, label_format, n=PERF_TOP_N):
+    rows = sorted(histogram.summary(), key=lambda row: row[3], reverse=True)[:n]
+    if not rows:
+        return "no data yet"
+    lines = [f"{label_format(labels)[:32]:<32} {count:>6} {mean * 1000:>8.1f} {p95 * 1000:>8.1f} {peak * 1000:>8.1f}"
+             for labels, count, mean, p95, peak in rows]
+    return "```\n" + f"{'':<32} {'count':>6} {'avg ms':>8} {'p95 ms':>8} {'max ms':>8}\n" + "\n".join(lines) + "```"
+
+
+class PerfCog(commands.Cog, name="Performance"):
+    def __init__(self, bot, write_buffer, dispatcher):
+        self.bot = bot
+        self.write_buffer = write_buffer
+        self.dispatcher = dispatcher
+
+    @hybrid_command()
+    @is_owner()
+    async def perf(self, ctx):
+        """Summarize the slowest commands, queries, REST routes and background loops since startup."""
+        embed = discord.Embed(title="Performance since startup", color=EMBED_COLOR)
+        embed.add_field(name="Commands", inline=False,
+                        value=slowest(COMMAND_SECONDS, lambda labels: f"{labels['command']} ({labels['status']})"))
+        embed.add_field(name="MongoDB", inline=False,
+                        value=slowest(MONGO_SECONDS, lambda labels: f"{labels['command']} {labels['collection']}"))
+        embed.add_field(name="Discord REST", inline=False, value=slowest(DISCORD_REST_SECONDS, lambda labels: labels['route']))
+        embed.add_field(name="Loops", inline=False, value=slowest(LOOP_SECONDS, lambda labels: labels['loop']))
+        embed.add_field(name="Loop drift", inline=False, value=slowest(LOOP_DRIFT_SECONDS, lambda labels: labels['loop']))
+        embed.set_footer(text=f"gateway latency {self.bot.latency * 1000:.0f}ms | "
+                              f"write backlog {self.write_buffer.backlog} | DM backlog {self.dispatcher.backlog}")
+        await ctx.send(embed=embed)
+
+
+async def setup(bot):
+    await bot.add_cog(PerfCog(bot, bot.write_buffer, bot.dispatcher))
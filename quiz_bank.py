@@ -0,0 +1,112 @@
+import hashlib
+import json
+import random
+
+import discord
+
+from pymongo import UpdateOne
+
+from logger_config import setup_logger
+
+QUIZ_BANK_META_ID = 'quiz_bank'
+QUIZ_SEED_META_ID = 'quiz_seed'
+QUIZ_FOOTER = ("React with the number corresponding to your answer. I'll DM you the answer. Quiz is "
+               "only valid for 12 hours. You can use !quiz to generate a new one.")
+
+
+class QuizBank:
+    """In-memory copy of `quiz_collection` with O(1) random selection.
+
+    Questions are indexed by their optional `category` and `difficulty` fields. Channels draw from shuffled decks, so
+    a channel does not see a question again until it has been through every matching question. The bank reloads
+    itself when the `version` stamp in `quiz_meta` changes; anything that edits `quiz_collection` must bump it via
+    `bump_version`. Rendered embeds are cached per question.
+    """
+    LOG = setup_logger("QuizBank")
+
+    def __init__(self, quiz_collection, quiz_meta_collection):
+        self.quiz_collection = quiz_collection
+        self.quiz_meta_collection = quiz_meta_collection
+        self.version = None
+        self._quizzes = []
+        self._by_id = {}
+        self._indexes = {}
+        self._decks = {}
+        self._embeds = {}
+
+    def __len__(self):
+        return len(self._quizzes)
+
+    async def current_version(self):
+        meta = await self.quiz_meta_collection.find_one({'_id': QUIZ_BANK_META_ID})
+        return meta.get('version', 0) if meta else 0
+
+    async def bump_version(self):
+        await self.quiz_meta_collection.update_one({'_id': QUIZ_BANK_META_ID}, {'$inc': {'version': 1}}, upsert=True)
+
+    async def seed(self, quizzes):
+        """Upsert `quizzes` (keyed by question) unless this exact set was already seeded; returns True if it wrote.
+
+        The seed file's hash is kept in `quiz_meta`, so an unchanged file costs one read on startup and an edited one
+        only touches its questions instead of reinserting everything.
+        """
+        digest = hashlib.sha256(json.dumps(quizzes, sort_keys=True).encode()).hexdigest()
+        meta = await self.quiz_meta_collection.find_one({'_id': QUIZ_SEED_META_ID})
+        if meta and meta.get('hash') == digest:
+            return False
+        result = await self.quiz_collection.bulk_write(
+            [UpdateOne({'question': quiz['question']}, {'$set': quiz}, upsert=True) for quiz in quizzes], ordered=False)
+        await self.quiz_meta_collection.update_one({'_id': QUIZ_SEED_META_ID}, {'$set': {'hash': digest}}, upsert=True)
+        if result.upserted_count or result.modified_count:
+            await self.bump_version()
+        self.LOG.info(f"seeded quizzes: {result.upserted_count} added, {result.modified_count} updated")
+        return True
+
+    async def refresh(self):
+        """Reload the bank if the stored version differs from the loaded one."""
+        version = await self.current_version()
+        if version == self.version:
+            return False
+        quizzes = await self.quiz_collection.find()
+        indexes = {}
+        for i, quiz in enumerate(quizzes):
+            for key in {(None, None), (quiz.get('category'), None), (None, quiz.get('difficulty')),
+                        (quiz.get('category'), quiz.get('difficulty'))}:
+                indexes.setdefault(key, []).append(i)
+        self._quizzes, self._indexes, self.version = quizzes, indexes, version
+        self._by_id = {quiz['_id']: quiz for quiz in quizzes}
+        self._decks.clear()
+        self._embeds.clear()
+        self.LOG.info(f"loaded {len(quizzes)} quizzes at version {version}")
+        return True
+
+    def sample(self, channel_id=None, category=None, difficulty=None):
+        """Pick a question matching the filters, without repeats per channel; None if nothing matches."""
+        candidates = self._indexes.get((category, difficulty))
+        if not candidates:
+            return None
+        if channel_id is None:
+            return self._quizzes[random.choice(candidates)]
+        key = (channel_id, category, difficulty)
+        deck = self._decks.get(key)
+        if not deck:
+            deck = self._decks[key] = random.sample(candidates, len(candidates))
+        return self._quizzes[deck.pop()]
+
+    def get(self, quiz_id):
+        return self._by_id.get(quiz_id)
+
+    def sample_excluding(self, quiz_ids):
+        """A random question from the whole bank whose id is not in `quiz_ids`; None if there is none."""
+        candidates = [quiz for quiz in self._quizzes if quiz['_id'] not in quiz_ids]
+        return random.choice(candidates) if candidates else None
+
+    def embed(self, quiz):
+        embed = self._embeds.get(quiz['_id'])
+        if embed is None:
+            embed = discord.Embed(title="📚 Quiz Time!", description=quiz['question'], color=0x3498db)
+            for i, option in enumerate(quiz['options']):
+                embed.add_field(name=f"Option {i + 1}", value=option, inline=False)
+            embed.set_footer(text=QUIZ_FOOTER)
+            self._embeds[quiz['_id']] = embed
+        return embed
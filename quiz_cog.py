@@ -1,77 +1,104 @@
+import asyncio
+import time
+
 import discord
 import pytz
 from discord.ext import commands, tasks
 import datetime
 
-from discord.ext.commands import hybrid_command
+from discord.app_commands import describe
+from discord.ext.commands import has_guild_permissions, hybrid_command
+from pymongo import InsertOne
 
 from logger_config import setup_logger
+from throttle import ResultCache, throttled
 
 TIMEZONE = pytz.timezone('America/New_York')
+ANSWER_EMOJIS = ['\u0031\uFE0F\u20E3', '\u0032\uFE0F\u20E3', '\u0033\uFE0F\u20E3', '\u0034\uFE0F\u20E3']
+QUIZ_FANOUT_CONCURRENCY = 20
 
 
 class QuizCog(commands.Cog, name="Quiz Commands"):
     LOG = setup_logger("QuizCog")
-
-    def __init__(self, bot, quiz_collection, active_quizzes_collection, user_answers_collection):
+    QUERY_SHAPES = [
+        ('user_stats', {'user_id': '0'}, None),
+        ('review_schedule', {'user_id': 0, 'due': {'$lte': 0}}, [('due', 1)]),
+        ('review_schedule', {'user_id': 0}, None),
+    ]
+
+    def __init__(self, bot, quiz_bank, active_quizzes, user_answers_collection, user_stats, dispatcher, write_buffer, guild_config,
+                 reviews):
         self.bot = bot
-        self.quiz_collection = quiz_collection
-        self.active_quizzes_collection = active_quizzes_collection
+        self.reviews = reviews
+        self.guild_config = guild_config
+        self._can_post = {}
+        self.write_buffer = write_buffer
+        self.dispatcher = dispatcher
+        self.user_stats = user_stats
+        self.quiz_bank = quiz_bank
+        self.active_quizzes = active_quizzes
         self.user_answers_collection = user_answers_collection
-        self.check_quizzes.start()
+        self.cache = ResultCache("quiz")
+
+    async def cog_load(self):
+        await self.quiz_bank.refresh()
+        await self.active_quizzes.load()
+        self.refresh_quiz_bank.start()
+        self.daily_quiz.start()
 
     def cog_unload(self):
-        self.check_quizzes.cancel()
+        self.refresh_quiz_bank.cancel()
+        self.daily_quiz.cancel()
+
+    @tasks.loop(minutes=5)
+    async def refresh_quiz_bank(self):
+        await self.quiz_bank.refresh()
 
     @hybrid_command(aliases=['q'])
-    async def quiz(self, ctx):
+    @describe(category="only ask questions from this category")
+    async def quiz(self, ctx, category: str = None):
         """Start a quiz."""
-        quiz = self.quiz_collection.aggregate([{'$sample': {'size': 1}}])
-        quiz = list(quiz)
-        if not quiz:
+        if not await self.post_quiz(ctx, ctx.channel.id, category):
             await ctx.send("No quiz questions found!")
-            return
-        quiz = quiz[0]
-        embed = discord.Embed(title="📚 Quiz Time!", description=quiz['question'], color=0x3498db)
-        for i, option in enumerate(quiz['options']):
-            embed.add_field(name=f"Option {i + 1}", value=option, inline=False)
-        embed.set_footer(text="React with the number corresponding to your answer. I'll DM you the answer. Quiz is "
-                              "only valid for 12 hours. You can use !quiz to generate a new one.")
-        message = await ctx.send(embed=embed)
-        emojis = ['\u0031\uFE0F\u20E3', '\u0032\uFE0F\u20E3', '\u0033\uFE0F\u20E3', '\u0034\uFE0F\u20E3']
-        for emoji in emojis:
-            await message.add_reaction(emoji)
 
-        # Store the active quiz in the database
-        self.active_quizzes_collection.insert_one({
-            'message_id': message.id,
-            'quiz': quiz,
-            'start_time': datetime.datetime.now(),
-            'answered_by': []
-        })
-
-    @tasks.loop(minutes=1)  # check every minute
-    async def check_quizzes(self):
-        """Delete quizzes that have expired."""
-        now = datetime.datetime.now()
-        self.active_quizzes_collection.delete_many({
-            'start_time': {
-                '$lt': now - datetime.timedelta(hours=12)
-            }
-        })
+    async def post_quiz(self, destination, channel_id, category=None):
+        """Send a quiz to a channel or context and track it; returns the message, or None if no question matches."""
+        quiz = self.quiz_bank.sample(channel_id=channel_id, category=category)
+        if not quiz:
+            return None
+        return await self.send_quiz(destination, quiz)
+
+    async def send_quiz(self, destination, quiz):
+        message = await destination.send(embed=self.quiz_bank.embed(quiz))
+        self.active_quizzes.add(message.id, quiz)
+        for emoji in ANSWER_EMOJIS:
+            await message.add_reaction(emoji)
+        return message
+
+    @hybrid_command(aliases=['qc'])
+    @has_guild_permissions(manage_channels=True)
+    async def quiz_channel(self, ctx):
+        """Toggle whether this channel receives the twice-daily quiz."""
+        added = await self.guild_config.toggle_list_value(ctx.guild.id, 'quiz_channel_ids', ctx.channel.id)
+        if added:
+            await ctx.send(f"{ctx.channel.mention} will now receive the daily quiz.")
+        else:
+            await ctx.send(f"{ctx.channel.mention} will no longer receive the daily quiz.")
 
     @commands.Cog.listener()
     async def on_reaction_add(self, reaction, user):
         """Check if a reaction is the answer to a quiz."""
+        # Check if the reaction is for an active quiz; this is an in-memory lookup
+        active_quiz = self.active_quizzes.get(reaction.message.id)
+        if active_quiz is None or reaction.emoji not in ANSWER_EMOJIS:
+            return
+
         # Ignore reactions from the bot
         if user == self.bot.user:
             return
 
-        # Check if the reaction is for an active quiz
-        active_quiz = self.active_quizzes_collection.find_one({'message_id': reaction.message.id})
-        if active_quiz and user.id not in active_quiz['answered_by']:
-            emojis = ['\u0031\uFE0F\u20E3', '\u0032\uFE0F\u20E3', '\u0033\uFE0F\u20E3', '\u0034\uFE0F\u20E3']
-            answer = emojis.index(reaction.emoji)
+        if self.active_quizzes.record_answer(reaction.message.id, user.id):
+            answer = ANSWER_EMOJIS.index(reaction.emoji)
             quiz = active_quiz['quiz']
             correct = answer == quiz['answer']
             if correct:
@@ -79,52 +106,91 @@ class QuizCog(commands.Cog, name="Quiz Commands"):
                                       description=f"The question was: {quiz['question']}.\nThe correct answer "
                                                   f"is:\n**{quiz['options'][quiz['answer']]}**.",
                                       color=0x00ff00)
-                await user.send(embed=embed)
+                self.dispatcher.send(user, embed=embed)
             else:
                 embed = discord.Embed(title="❌ Incorrect.",
                                       description=f"Sorry, the correct answer was\n**{quiz['options'][quiz['answer']]}**.\nThe question was:\n{quiz['question']}.",
                                       color=0xff0000)
-                await user.send(embed=embed)
-
-            # Update the active quiz in the database
-            self.active_quizzes_collection.update_one(
-                {'message_id': reaction.message.id},
-                {
-                    '$push': {'answered_by': user.id},
-                    '$currentDate': {'last_interaction': True}
-                }
-            )
+                self.dispatcher.send(user, embed=embed)
 
             # Store the user's answer in the database
-            self.user_answers_collection.insert_one({
+            self.write_buffer.add(self.user_answers_collection, InsertOne({
                 'user_id': user.id,
                 'quiz_id': quiz['_id'],
                 'correct': correct
-            })
+            }))
+            self.user_stats.add_answer(str(user.id), correct)
+            self.reviews.record(user.id, quiz['_id'], correct)
 
     @hybrid_command(aliases=['qr'])
+    @throttled()
     async def quiz_report(self, ctx):
         """Report the correct rate of the user."""
-        answers = list(self.user_answers_collection.find({'user_id': ctx.author.id}))
-        if not answers:
+        user_id = str(ctx.author.id)
+        user_data = await self.cache.get(('quiz_report', user_id, self.user_stats.version(user_id)),
+                                         lambda: self.user_stats.get(user_id))
+        if not user_data or not user_data.get('quiz_answered'):
             await ctx.send("You haven't answered any quizzes yet.")
             return
-        correct_answers = sum(1 for answer in answers if answer['correct'])
-        correct_rate = correct_answers / len(answers)
+        correct_rate = user_data.get('quiz_correct', 0) / user_data['quiz_answered']
         await ctx.send(f"{ctx.message.author.mention} Your correct rate is {correct_rate:.2%}.")
 
+    @hybrid_command(aliases=['rv'])
+    async def review(self, ctx):
+        """Get the question you are due to review next, based on how well you answered it before."""
+        quiz, next_due = await self.reviews.next_review(ctx.author.id)
+        if quiz is not None:
+            await self.send_quiz(ctx, quiz)
+        elif next_due is not None:
+            next_due = discord.utils.format_dt(datetime.datetime.fromtimestamp(next_due, datetime.timezone.utc), 'R')
+            await ctx.send(f"{ctx.message.author.mention} nothing to review right now, your next review is due {next_due}.")
+        else:
+            await ctx.send("No quiz questions found!")
+
+    def can_post(self, channel):
+        """Whether the bot may post and react in `channel`; cached until channel or role permissions change."""
+        allowed = self._can_post.get(channel.id)
+        if allowed is None:
+            permissions = channel.permissions_for(channel.guild.me)
+            allowed = self._can_post[channel.id] = (permissions.send_messages and permissions.embed_links
+                                                    and permissions.add_reactions)
+        return allowed
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        self._can_post.pop(after.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        self._can_post.clear()
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if after.id == self.bot.user.id:
+            self._can_post.clear()
+
     @tasks.loop(hours=12)
     async def daily_quiz(self, ):
-        self.LOG.info("run daily quiz")
+        started = time.perf_counter()
+        channels = []
         for guild in self.bot.guilds:
-            for channel in guild.text_channels:
-                async for message in channel.history(limit=1):
-                    ctx = await self.bot.get_context(message)
-                    await self.quiz(ctx)
-                    self.LOG.info(f"quiz channel {channel}")
-                    break
-                else:
-                    await channel.send("Remember to study and check in today!")
+            for channel_id in self.guild_config.quiz_channel_ids(guild.id):
+                channel = guild.get_channel(channel_id)
+                if channel is not None and self.can_post(channel):
+                    channels.append(channel)
+
+        semaphore = asyncio.Semaphore(QUIZ_FANOUT_CONCURRENCY)
+
+        async def post(channel):
+            async with semaphore:
+                await self.post_quiz(channel, channel.id)
+
+        results = await asyncio.gather(*(post(channel) for channel in channels), return_exceptions=True)
+        failures = [(channel, result) for channel, result in zip(channels, results) if isinstance(result, Exception)]
+        for channel, error in failures:
+            self.LOG.warning(f"daily quiz failed in {channel.guild}/{channel}: {error!r}")
+        self.LOG.info(f"daily quiz posted to {len(channels) - len(failures)}/{len(channels)} channels, "
+                      f"{len(failures)} failed, in {time.perf_counter() - started:.2f}s")
 
     @daily_quiz.before_loop
     async def before_daily_reminder(self, ):
@@ -135,4 +201,9 @@ class QuizCog(commands.Cog, name="Quiz Commands"):
             next_reminder = now.replace(hour=20, minute=0, second=0)
         else:
             next_reminder = (now + datetime.timedelta(days=1)).replace(hour=8, minute=0, second=0)
-        await discord.utils.sleep_until(next_reminder)
\ No newline at end of file
+        await discord.utils.sleep_until(next_reminder)
+
+
+async def setup(bot):
+    await bot.add_cog(QuizCog(bot, bot.quiz_bank, bot.active_quizzes, bot.user_answers_collection, bot.user_stats,
+                              bot.dispatcher, bot.write_buffer, bot.guild_config, bot.reviews))
@@ -0,0 +1,91 @@
+import datetime
+import time
+
+from pymongo import UpdateOne
+
+from logger_config import setup_logger
+from metrics import JOB_SECONDS
+
+ROLLOVER_CHUNK_SIZE = 1000
+
+
+class DailyRollover:
+    """Midnight reset of `study_times.daily_study_time`, run as a resumable batched job.
+
+    Only documents with study time that day are touched: they are paged through in `_id` order, filtered by a
+    partial index, and reset with one unordered `bulk_write` per chunk. A reset only applies to documents last
+    checked out before the run started, so check-outs made while a long run is under way keep the new day's time.
+    The last `_id` reset is checkpointed in the `jobs` collection after every chunk, so an interrupted run is picked
+    up where it stopped by `resume_interrupted` on the next start and a finished one is never repeated. Only the current day's run is resumed: by the next day the counters hold that day's study time, which
+    a late reset would wipe, so older unfinished runs are marked abandoned instead.
+    """
+    LOG = setup_logger("DailyRollover")
+
+    def __init__(self, study_times_collection, jobs_collection, write_buffer, chunk_size=ROLLOVER_CHUNK_SIZE):
+        self.study_times_collection = study_times_collection
+        self.write_buffer = write_buffer
+        self.jobs_collection = jobs_collection
+        self.chunk_size = chunk_size
+
+    @JOB_SECONDS.time(job='daily_rollover')
+    async def run(self, date):
+        job_id = f"daily_rollover:{date}"
+        job = await self.jobs_collection.find_one({'_id': job_id}) or {}
+        if job.get('completed_at'):
+            return job
+        if job:
+            self.LOG.info(f"resuming {job_id} after {job.get('processed', 0)} users")
+
+        processed, chunks, last_id = job.get('processed', 0), job.get('chunks', 0), job.get('last_id')
+        # Check-outs from before this point belong to the day being closed; later ones are the new day's
+        cutoff = job.get('started_at') or datetime.datetime.utcnow().replace(microsecond=0)
+        started = time.perf_counter()
+        await self.write_buffer.flush_pending(self.study_times_collection)
+        await self.jobs_collection.update_one(
+            {'_id': job_id},
+            {'$setOnInsert': {'started_at': cutoff}},
+            upsert=True
+        )
+        while True:
+            query = {'daily_study_time': {'$gt': 0}}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            active = await self.study_times_collection.find(query, {'_id': 1}, sort=[('_id', 1)], limit=self.chunk_size)
+            if not active:
+                break
+            await self.study_times_collection.bulk_write(
+                [UpdateOne({'_id': doc['_id'], 'daily_updated_at': {'$not': {'$gte': cutoff}}},
+                           {'$set': {'daily_study_time': 0}}) for doc in active],
+                ordered=False
+            )
+            processed += len(active)
+            chunks += 1
+            last_id = active[-1]['_id']
+            await self.jobs_collection.update_one(
+                {'_id': job_id},
+                {'$set': {'processed': processed, 'chunks': chunks, 'last_id': last_id}}
+            )
+            self.LOG.info(f"{job_id}: reset {processed} users in {chunks} chunks, "
+                          f"{time.perf_counter() - started:.2f}s elapsed")
+
+        duration = time.perf_counter() - started
+        job = {'processed': processed, 'chunks': chunks, 'duration_seconds': duration,
+               'completed_at': datetime.datetime.utcnow()}
+        await self.jobs_collection.update_one({'_id': job_id}, {'$set': job})
+        self.LOG.info(f"{job_id} completed: {processed} users in {chunks} chunks, {duration:.2f}s")
+        return job
+
+    async def resume_interrupted(self, today):
+        """Finish an interrupted rollover for `today` (YYYY-MM-DD); returns True if one was resumed."""
+        resumed = False
+        for job in await self.jobs_collection.find({'_id': {'$regex': '^daily_rollover:'}, 'completed_at': None,
+                                                    'abandoned_at': None}):
+            date = job['_id'].split(':', 1)[1]
+            if date == today:
+                await self.run(date)
+                resumed = True
+            else:
+                self.LOG.warning(f"abandoning {job['_id']}, interrupted after {job.get('processed', 0)} users")
+                await self.jobs_collection.update_one({'_id': job['_id']},
+                                                      {'$set': {'abandoned_at': datetime.datetime.utcnow()}})
+        return resumed
@@ -0,0 +1,92 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from logger_config import setup_logger
+
+
+class DeadlineScheduler:
+    """Runs callbacks at absolute deadlines (POSIX timestamps) from a single heap.
+
+    One background task sleeps until the earliest deadline, so cost is O(log n) per schedule/fire instead of a
+    periodic scan over every pending item. Each key has at most one pending deadline; rescheduling or cancelling
+    a key leaves a stale heap entry that is skipped lazily when it reaches the top.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.LOG = setup_logger(name)
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"{self.name}-scheduler")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._running:
+            task.cancel()
+
+    def schedule(self, key, deadline, callback):
+        """Call `await callback()` at `deadline`, replacing any deadline already pending for `key`."""
+        seq = next(self._counter)
+        self._entries[key] = (deadline, seq, callback)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        return self._entries.pop(key, None) is not None
+
+    def _pop_stale(self):
+        while self._heap:
+            deadline, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            self._pop_stale()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[1] != seq:
+                    continue
+                del self._entries[key]
+                task = asyncio.create_task(self._fire(key, entry[2]))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _fire(self, key, callback):
+        try:
+            await callback()
+        except Exception:
+            self.LOG.exception(f"scheduled callback for {key} failed")
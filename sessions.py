@@ -0,0 +1,177 @@
+import asyncio
+import datetime
+
+from pymongo import ReturnDocument, UpdateOne
+
+from logger_config import setup_logger
+
+
+class StudySessions:
+    """Open study sessions per (user_id, channel_id), authoritative in memory and written through to `study_times`.
+
+    Check-in and check-out claim or release a session with a single dict operation, so a double check-in (or a
+    check-out without a session) is rejected without reading Mongo. Check-in writes through with one
+    find_one_and_update that also returns the goal and daily total used by check-out; check-out writes go through
+    the write buffer together with the leaderboard, counter and study history updates. `load` rehydrates the open
+    sessions after a restart; code that runs during startup and must see them awaits `wait_loaded` first.
+    """
+    LOG = setup_logger("StudySessions")
+
+    def __init__(self, study_times_collection, history, leaderboards, user_stats, write_buffer):
+        self.study_times_collection = study_times_collection
+        self.history = history
+        self.leaderboards = leaderboards
+        self.user_stats = user_stats
+        self.write_buffer = write_buffer
+        self._open = {}
+        self._loaded = asyncio.Event()
+
+    def __len__(self):
+        return len(self._open)
+
+    def is_open(self, user_id, channel_id):
+        return (user_id, channel_id) in self._open
+
+    def open_in(self, channel_ids):
+        """Return the (user_id, channel_id) of every open session in one of `channel_ids`."""
+        return [(user_id, channel_id) for user_id, channel_id in self._open if channel_id in channel_ids]
+
+    async def load(self):
+        open_sessions = await self.study_times_collection.find(
+            {'check_in_time': {'$exists': True}},
+            {'user_id': 1, 'channel_id': 1, 'check_in_time': 1, 'goal': 1, 'daily_study_time': 1}
+        )
+        for user_data in open_sessions:
+            self._open[(user_data['user_id'], user_data['channel_id'])] = {
+                'check_in_time': user_data['check_in_time'],
+                'goal': user_data.get('goal'),
+                'daily_study_time': user_data.get('daily_study_time', 0),
+            }
+        self._loaded.set()
+        self.LOG.info(f"rehydrated {len(self._open)} open study sessions")
+
+    async def wait_loaded(self):
+        await self._loaded.wait()
+
+    async def check_in(self, user_id, channel_id, check_in_time=None):
+        """Open a session; False if one is already open for this user and channel."""
+        key = (user_id, channel_id)
+        if key in self._open:
+            return False
+        session = self._open[key] = {'check_in_time': check_in_time or datetime.datetime.now()}
+        try:
+            # A buffered check-out for the same document must land before this check-in
+            await self.write_buffer.flush_pending(self.study_times_collection, key)
+            user_data = await self.study_times_collection.find_one_and_update(
+                {'user_id': user_id, 'channel_id': channel_id},
+                {'$set': {'check_in_time': session['check_in_time']}},
+                projection={'goal': 1, 'daily_study_time': 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception:
+            self._open.pop(key, None)
+            raise
+        session['goal'] = user_data.get('goal')
+        session['daily_study_time'] = user_data.get('daily_study_time', 0)
+        return True
+
+    async def check_in_many(self, sessions):
+        """Open several sessions, given as (user_id, channel_id, check_in_time), with one bulk write and one read.
+
+        Sessions that are already open are skipped. Returns the number of sessions opened.
+        """
+        claimed = {}
+        for user_id, channel_id, check_in_time in sessions:
+            key = (user_id, channel_id)
+            if key not in self._open:
+                claimed[key] = self._open[key] = {'check_in_time': check_in_time}
+        if not claimed:
+            return 0
+        by_channel = {}
+        for user_id, channel_id in claimed:
+            by_channel.setdefault(channel_id, []).append(user_id)
+        try:
+            await self.write_buffer.flush_pending(self.study_times_collection, *claimed)
+            await self.study_times_collection.bulk_write([
+                UpdateOne({'user_id': user_id, 'channel_id': channel_id},
+                          {'$set': {'check_in_time': session['check_in_time']}}, upsert=True)
+                for (user_id, channel_id), session in claimed.items()
+            ], ordered=False)
+            user_data = await self.study_times_collection.find(
+                {'$or': [{'channel_id': channel_id, 'user_id': {'$in': user_ids}}
+                         for channel_id, user_ids in by_channel.items()]},
+                {'user_id': 1, 'channel_id': 1, 'goal': 1, 'daily_study_time': 1}
+            )
+        except Exception:
+            for key in claimed:
+                self._open.pop(key, None)
+            raise
+        for document in user_data:
+            session = claimed.get((document['user_id'], document['channel_id']))
+            if session is not None:
+                session['goal'] = document.get('goal')
+                session['daily_study_time'] = document.get('daily_study_time', 0)
+        return len(claimed)
+
+    def check_out(self, user_id, channel_id, guild_id, check_out_time=None):
+        """Close a session and queue its writes.
+
+        Returns a dict with the session's `study_time`, the user's `goal` (None if unset) and their `daily_study_time`
+        including this session, or None if no session was open.
+        """
+        session = self._open.pop((user_id, channel_id), None)
+        if session is None:
+            return None
+        check_out_time = check_out_time or datetime.datetime.now()
+        study_time = max((check_out_time - session['check_in_time']).total_seconds(), 0)
+
+        fields = {'daily_updated_at': datetime.datetime.utcnow()}
+        if guild_id is not None:
+            # Lets the leaderboard backfill find the guild board without the gateway cache
+            fields['guild_id'] = guild_id
+        self.write_buffer.add(self.study_times_collection, UpdateOne(
+            {'user_id': user_id, 'channel_id': channel_id},
+            {'$inc': {'total_study_time': study_time, 'daily_study_time': study_time}, '$unset': {'check_in_time': ""},
+             '$set': fields},
+            upsert=True
+        ), key=(user_id, channel_id))
+        self.leaderboards.add_study_time(user_id, channel_id, guild_id, study_time)
+        self.user_stats.add_study_time(user_id, study_time, check_out_time)
+        self.history.add_study_time(user_id, study_time, check_out_time)
+        return {
+            'study_time': study_time,
+            'goal': session.get('goal'),
+            'daily_study_time': session.get('daily_study_time', 0) + study_time,
+        }
+
+    async def check_out_many(self, user_ids, channel_id, guild_id, check_out_time):
+        """Close the sessions of several users in one channel as of `check_out_time` and flush their writes.
+
+        Sessions opened after `check_out_time` are left open, so running this again after a crash is harmless.
+        Returns a dict of user id -> check-out result for the sessions that were closed.
+        """
+        closed = {}
+        for user_id in user_ids:
+            session = self._open.get((user_id, channel_id))
+            if session is not None and session['check_in_time'] <= check_out_time:
+                closed[user_id] = self.check_out(user_id, channel_id, guild_id, check_out_time)
+        if closed:
+            await self.write_buffer.flush_pending(self.study_times_collection,
+                                                  *((user_id, channel_id) for user_id in closed))
+        return closed
+
+    async def set_goal(self, user_id, channel_id, goal):
+        await self.study_times_collection.update_one(
+            {'user_id': user_id, 'channel_id': channel_id},
+            {'$set': {'goal': goal}},
+            upsert=True
+        )
+        session = self._open.get((user_id, channel_id))
+        if session is not None:
+            session['goal'] = goal
+
+    def reset_daily(self):
+        """Mirror the midnight rollover for sessions that are open across it."""
+        for session in self._open.values():
+            session['daily_study_time'] = 0
@@ -0,0 +1,98 @@
+import time
+
+from pymongo import UpdateOne
+
+from logger_config import setup_logger
+
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+DAY_SECONDS = 24 * 60 * 60
+# Reactions only say right or wrong, so they map to SM-2 grades 4 ("correct after some thought") and 1
+CORRECT_GRADE = 4
+INCORRECT_GRADE = 1
+
+
+def ease_change(grade):
+    return 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02)
+
+
+def _sm2_update(correct, now):
+    """Update pipeline applying one SM-2 step to a review_schedule document (created on the first answer).
+
+    The first stage reads the fields as they were before the answer; the second derives `due` from the new interval.
+    """
+    repetitions = {'$ifNull': ['$repetitions', 0]}
+    interval = {'$ifNull': ['$interval', 0]}
+    ease = {'$ifNull': ['$ease', DEFAULT_EASE]}
+    grade = CORRECT_GRADE if correct else INCORRECT_GRADE
+    if correct:
+        new_interval = {'$switch': {'branches': [{'case': {'$eq': [repetitions, 0]}, 'then': 1},
+                                                 {'case': {'$eq': [repetitions, 1]}, 'then': 6}],
+                                    'default': {'$ceil': {'$multiply': [interval, ease]}}}}
+        new_repetitions = {'$add': [repetitions, 1]}
+    else:
+        new_interval, new_repetitions = 1, 0
+    return [
+        {'$set': {
+            'interval': new_interval,
+            'repetitions': new_repetitions,
+            'ease': {'$max': [MIN_EASE, {'$add': [ease, ease_change(grade)]}]},
+            'lapses': {'$add': [{'$ifNull': ['$lapses', 0]}, 0 if correct else 1]},
+            'reviewed_at': now,
+        }},
+        {'$set': {'due': {'$add': [now, {'$multiply': ['$interval', DAY_SECONDS]}]}}},
+    ]
+
+
+class ReviewScheduler:
+    """SM-2 spaced-repetition state per (user, question) in the `review_schedule` collection.
+
+    Each answer is one upsert of a small document through the write buffer; the SM-2 step runs as an update pipeline
+    on the server, so answering never reads. Due items are read through the (user_id, due) index, most overdue
+    first, so picking a due review is an index seek regardless of how many answers a user has given; when nothing is
+    due, a new question is drawn from the bank minus the user's scheduled ids, read from the (user_id, quiz_id) index.
+    User ids are ints, as in `user_answers`; `due` and `reviewed_at` are POSIX timestamps.
+    """
+    LOG = setup_logger("ReviewScheduler")
+
+    def __init__(self, review_schedule_collection, quiz_bank, write_buffer):
+        self.review_schedule_collection = review_schedule_collection
+        self.quiz_bank = quiz_bank
+        self.write_buffer = write_buffer
+
+    def record(self, user_id, quiz_id, correct, now=None):
+        now = now or time.time()
+        self.write_buffer.add(self.review_schedule_collection, UpdateOne(
+            {'user_id': user_id, 'quiz_id': quiz_id}, _sm2_update(correct, now), upsert=True))
+
+    async def due(self, user_id, now=None, limit=10):
+        """The user's schedule documents that are due, most overdue first."""
+        now = now or time.time()
+        await self.write_buffer.flush_pending(self.review_schedule_collection)
+        return await self.review_schedule_collection.find(
+            {'user_id': user_id, 'due': {'$lte': now}}, {'quiz_id': 1, 'due': 1}, sort=[('due', 1)], limit=limit)
+
+    async def next_review(self, user_id, now=None):
+        """Pick the question to review next: the most overdue one, else a random one the user has never answered.
+
+        Returns (quiz, None), or (None, when the next review is due) if nothing is due and every question has been
+        answered, or (None, None) if the bank is empty.
+        """
+        now = now or time.time()
+        for item in await self.due(user_id, now):
+            quiz = self.quiz_bank.get(item['quiz_id'])
+            if quiz is not None:
+                return quiz, None
+            # The question was removed from the bank
+            await self.review_schedule_collection.delete_one({'_id': item['_id']})
+
+        # Covered by the (user_id, quiz_id) index, so this reads index keys only
+        scheduled = {item['quiz_id'] for item in await self.review_schedule_collection.find(
+            {'user_id': user_id}, {'quiz_id': 1, '_id': 0})}
+        quiz = self.quiz_bank.sample_excluding(scheduled)
+        if quiz is not None:
+            return quiz, None
+
+        upcoming = await self.review_schedule_collection.find(
+            {'user_id': user_id}, {'due': 1}, sort=[('due', 1)], limit=1)
+        return None, upcoming[0]['due'] if upcoming else None
@@ -1,75 +1,86 @@
+import asyncio
 import datetime
 import discord
+import io
 import math
+import time
+
 import pytz
 from discord.ext import commands, tasks
 from discord.ext.commands import hybrid_command
 
 from Util import Utils
+from charts import render_history_chart
+from leaderboard import channel_scope, guild_scope
 from logger_config import setup_logger
+from throttle import ResultCache, throttled
+from user_stats import week_start
 
 TIMEZONE = pytz.timezone('America/New_York')
 COLUMN_WIDTH = 15
 LEADERBOARD_COLUMN_NAME = "```\nUser           | Study Time\n"
 LEADERBOARD_COLUMN_SPLITTER = f"{'-' * COLUMN_WIDTH}|-----------\n"
 EMBED_COLOR = 0X78C2C4
+PROGRESS_REPORT_BATCH_SIZE = 1000
 
 
 class StatsCog(commands.Cog, name="Stats Commands"):
     LOG = setup_logger("StatsCog")
+    QUERY_SHAPES = [
+        ('user_stats', {'user_id': '0'}, None),
+        ('study_history', {'user_id': '0', 'month': {'$lte': '1970-01'}}, None),
+    ]
 
-    def __init__(self, bot, study_times_collection, user_daily_study_time_collection, user_levels_collection, user_answers_collection):
+    def __init__(self, bot, user_levels_collection, user_stats, user_resolver, leaderboards, dispatcher, history, charts):
         self.bot = bot
-        self.study_times_collection = study_times_collection
-        self.user_daily_study_time_collection = user_daily_study_time_collection
+        self.dispatcher = dispatcher
+        self.user_stats = user_stats
+        self.user_resolver = user_resolver
+        self.leaderboards = leaderboards
+        self.history = history
+        self.charts = charts
         self.user_levels_collection = user_levels_collection
-        self.user_answers_collection = user_answers_collection
+        self.cache = ResultCache("stats")
         self.progress_reports.start()
-    
-    def calculate_weekly_study_time(self, user_id, start_of_week, end_of_week):
-        weekly_data = self.user_daily_study_time_collection.find({
-            'user_id': user_id,
-            'date': {'$gte': start_of_week, '$lte': end_of_week}
-        })
-
-        weekly_study_time = sum(day.get('study_time_this_day', 0) for day in weekly_data)
-
-        return weekly_study_time
-    
 
     @hybrid_command()
+    @throttled()
     async def report(self, ctx):
         user_id = str(ctx.message.author.id)
-        user_data = self.study_times_collection.find_one({'user_id': user_id})
-
-        if not user_data:
+        now = datetime.datetime.now()
+        # Same user, same day, no new study time or answers: the report can't have changed
+        key = ('report', user_id, now.strftime('%Y-%m-%d'), self.user_stats.version(user_id))
+        message = await self.cache.get(key, lambda: self.build_report(user_id, now))
+        if message is None:
             await ctx.send(f"{ctx.message.author.mention}, you don't have any recorded study data yet.")
             return
+        await ctx.send(message)
+
+    async def build_report(self, user_id, now):
+        # The streak reads a small bounded window of history buckets, so it runs alongside the user_stats read
+        user_data, streak = await asyncio.gather(self.user_stats.get(user_id), self.history.streak(user_id, now.date()))
+        if not user_data:
+            return None
         total_study_time = user_data.get("total_study_time", 0)
-        daily_study_time = user_data.get("daily_study_time", 0)
-        answers = list(self.user_answers_collection.find({'user_id': ctx.author.id}))
-        if not answers:
-            correct_answers = 0
-        else:
-            correct_answers = sum(1 for answer in answers if answer['correct'])
-        
+        daily_study_time = user_data.get("daily_study_time", 0) if user_data.get("daily_date") == now.strftime('%Y-%m-%d') else 0
+        weekly_study_time = user_data.get("weekly_study_time", 0) if user_data.get("week_start") == week_start(now) else 0
+        correct_answers = user_data.get("quiz_correct", 0)
+
         xp = (total_study_time / 60) * 0.5 + correct_answers * 50
         def calculate_level(xp):
             level = (xp / 50) ** 0.5
             return math.floor(level)
         level = calculate_level(xp)
-        self.user_levels_collection.update_one(
-                {'user_id': user_id},
-                {'$set': {'xp': xp, 'level': level}},
-                upsert=True
+        if level != user_data.get("level"):
+            await asyncio.gather(
+                self.user_levels_collection.update_one(
+                    {'user_id': user_id},
+                    {'$set': {'xp': xp, 'level': level}},
+                    upsert=True
+                ),
+                self.user_stats.set_level(user_id, xp, level)
             )
 
-        today = datetime.datetime.now()
-        start_of_week = (today - datetime.timedelta(days=today.weekday())).strftime('%Y-%m-%d')
-        end_of_week = (today - datetime.timedelta(days=today.weekday()) + datetime.timedelta(days=6)).strftime('%Y-%m-%d')
-
-        weekly_study_time = self.calculate_weekly_study_time(user_id, start_of_week, end_of_week)
-
         human_readable_time_total = Utils.convert_seconds_to_time(total_study_time)
         human_readable_time_daily = Utils.convert_seconds_to_time(daily_study_time)
         human_readable_time_weekly = Utils.convert_seconds_to_time(weekly_study_time)
@@ -77,52 +88,122 @@ class StatsCog(commands.Cog, name="Stats Commands"):
         message = f'LEVEL: **{level}**  |  XP: **{int(xp)}**\n' \
                   f'DAILY: {human_readable_time_daily}\n' \
                   f'WEEKLY: {human_readable_time_weekly}\n' \
-                  f'ALL TIME: {human_readable_time_total}\n'
-            
+                  f'ALL TIME: {human_readable_time_total}\n' \
+                  f'STREAK: {streak} day{"s" if streak != 1 else ""}\n'
+        return message
+
+    async def render_leaderboard(self, board, guild):
+        top_users = board.top(100)
+        user_names = await self.user_resolver.resolve_many([int(user_id) for user_id, _ in top_users], guild)
+        self.LOG.info(f"resolved {len(user_names)} leaderboard names, resolver stats: {self.user_resolver.stats}")
+        leaderboard_text = LEADERBOARD_COLUMN_NAME
+        leaderboard_text += LEADERBOARD_COLUMN_SPLITTER
+        for user_id, total_study_time in top_users:
+            name = user_names[int(user_id)]
+            total_study_time = Utils.convert_seconds_to_time(total_study_time)
+            leaderboard_text += f"{name[:COLUMN_WIDTH]:<{COLUMN_WIDTH}}| {total_study_time}\n"
+        leaderboard_text += "```"
+        return leaderboard_text
+
+    async def cached_leaderboard(self, board, guild):
+        # Board versions are unique and change on every update, so a render is reused until the board changes
+        return await self.cache.get(('leaderboard', board.version), lambda: self.render_leaderboard(board, guild))
 
-        await ctx.send(message)
     @hybrid_command(aliases=['lb'])
+    @throttled()
     async def leaderboard(self, ctx):
         """Display a leaderboard showing the total study times within the channel."""
-        channel_id = str(ctx.channel.id)
-        leaderboard_text = LEADERBOARD_COLUMN_NAME
-        leaderboard_text += LEADERBOARD_COLUMN_SPLITTER
-        sorted_users = self.study_times_collection.find({'channel_id': channel_id}).sort('total_study_time', -1).limit(
-            100)
-        for user_data in sorted_users:
-            user = await self.bot.fetch_user(int(user_data['user_id']))
-            total_study_time = Utils.convert_seconds_to_time(user_data["total_study_time"])
-            leaderboard_text += f"{user.name[:COLUMN_WIDTH]:<{COLUMN_WIDTH}}| {total_study_time}\n"
-        leaderboard_text += "```"
+        board = self.leaderboards.board(channel_scope(ctx.channel.id))
+        leaderboard_text = await self.cached_leaderboard(board, ctx.guild)
         embed = discord.Embed(title="Leaderboard for this channel", description=leaderboard_text, color=EMBED_COLOR)
         await ctx.send(embed=embed)
 
     @hybrid_command(aliases=['olb'])
+    @throttled()
     async def overall_leaderboard(self, ctx):
         """Display a leaderboard showing the total study times within the server."""
-        leaderboard_text = LEADERBOARD_COLUMN_NAME
-        leaderboard_text += LEADERBOARD_COLUMN_SPLITTER
-
-        sorted_users = self.study_times_collection.find().sort('total_study_time', -1).limit(100)
-        for user_data in sorted_users:
-            user = await self.bot.fetch_user(int(user_data['user_id']))
-            total_study_time = Utils.convert_seconds_to_time(user_data["total_study_time"])
-            leaderboard_text += f"{user.name[:COLUMN_WIDTH]:<{COLUMN_WIDTH}}| {total_study_time}\n"
-        leaderboard_text += "```"
+        if ctx.guild is None:
+            await ctx.send(f"{ctx.message.author.mention}, the server leaderboard is only available in a server.")
+            return
+        board = self.leaderboards.board(guild_scope(ctx.guild.id))
+        leaderboard_text = await self.cached_leaderboard(board, ctx.guild)
         embed = discord.Embed(title="Server Leaderboard", description=leaderboard_text, color=EMBED_COLOR)
         await ctx.send(embed=embed)
 
+    @hybrid_command(aliases=['rk'])
+    async def rank(self, ctx):
+        """Show your leaderboard position in this channel and on this server."""
+        user_id = str(ctx.message.author.id)
+        scopes = [("this channel", self.leaderboards.board(channel_scope(ctx.channel.id)))]
+        if ctx.guild is not None:
+            scopes.append(("this server", self.leaderboards.board(guild_scope(ctx.guild.id))))
+        lines = []
+        for label, board in scopes:
+            position = board.rank(user_id)
+            if position is None:
+                lines.append(f"{label.capitalize()}: not ranked yet")
+            else:
+                lines.append(f"{label.capitalize()}: **#{position}** of {len(board)} "
+                             f"({Utils.convert_seconds_to_time(board.total(user_id))})")
+        await ctx.send(f"{ctx.message.author.mention}\n" + "\n".join(lines))
+
+    @hybrid_command(aliases=['hs'])
+    async def history(self, ctx):
+        """Show your study history for the last 30 days, 12 weeks and 12 months as a chart."""
+        user_id = str(ctx.message.author.id)
+        overview = await self.history.overview(user_id, datetime.datetime.now().date())
+        if not any(seconds for _, seconds in overview['monthly']):
+            await ctx.send(f"{ctx.message.author.mention}, you don't have any recorded study data yet.")
+            return
+
+        def hours(series, label_format):
+            return tuple((label if isinstance(label, str) else label.strftime(label_format), round(seconds / 3600, 2))
+                         for label, seconds in series)
+
+        lines = [
+            f"STREAK: {overview['streak']} day{'s' if overview['streak'] != 1 else ''}",
+            f"LAST 30 DAYS: {Utils.convert_seconds_to_time(sum(seconds for _, seconds in overview['daily']))}",
+            f"LAST 12 MONTHS: {Utils.convert_seconds_to_time(sum(seconds for _, seconds in overview['monthly']))}",
+        ]
+        scopes = [("this channel", self.leaderboards.board(channel_scope(ctx.channel.id)))]
+        if ctx.guild is not None:
+            scopes.append(("this server", self.leaderboards.board(guild_scope(ctx.guild.id))))
+        for label, board in scopes:
+            position = board.rank(user_id)
+            if position is not None:
+                lines.append(f"Top **{max(round(100 * position / len(board)), 1)}%** in {label}")
+        embed = discord.Embed(title=f"Study history for {ctx.author.display_name}", description="\n".join(lines),
+                              color=EMBED_COLOR)
+
+        try:
+            png = await self.charts.render(render_history_chart, "Study time (hours)",
+                                           hours(overview['daily'], '%m-%d'), hours(overview['weekly'], '%m-%d'),
+                                           hours(overview['monthly'], '%Y-%m'))
+        except Exception:
+            self.LOG.exception(f"rendering the history chart for {user_id} failed, sending it without the chart")
+            await ctx.send(embed=embed)
+            return
+        embed.set_image(url="attachment://history.png")
+        await ctx.send(embed=embed, file=discord.File(io.BytesIO(png), filename="history.png"))
+
     @tasks.loop(hours=24)
     async def progress_reports(self, ):
+        started = time.perf_counter()
+        sent_before, failed_before = self.dispatcher.stats['sent'], self.dispatcher.stats['failed']
         for guild in self.bot.guilds:
-            for member in guild.members:
-
-                user_id = str(member.id)
-                user_data = self.study_times_collection.find_one({'user_id': user_id})
-                if user_data and 'total_study_time' in user_data:
-                    total_study_time = Utils.convert_seconds_to_time(user_data["total_study_time"])
-                    await member.send(f'Your total study time is: {total_study_time}')
-                    self.LOG.info(f"Generated report for {member}")
+            members = [member for member in guild.members if not member.bot]
+            for i in range(0, len(members), PROGRESS_REPORT_BATCH_SIZE):
+                batch = members[i:i + PROGRESS_REPORT_BATCH_SIZE]
+                stats = await self.user_stats.get_many(str(member.id) for member in batch)
+                for member in batch:
+                    user_data = stats.get(str(member.id))
+                    if user_data and 'total_study_time' in user_data:
+                        total_study_time = Utils.convert_seconds_to_time(user_data["total_study_time"])
+                        self.dispatcher.send(member, f'Your total study time is: {total_study_time}')
+        await self.dispatcher.drain()
+        self.LOG.info(f"progress reports: sent {self.dispatcher.stats['sent'] - sent_before}, "
+                      f"failed {self.dispatcher.stats['failed'] - failed_before} "
+                      f"in {time.perf_counter() - started:.1f}s ({self.dispatcher.throughput():.1f} DMs/s overall)")
 
     @progress_reports.before_loop
     async def before_progress_reports(self, ):
@@ -131,3 +212,8 @@ class StatsCog(commands.Cog, name="Stats Commands"):
         if now.hour >= 12:
             next_report += datetime.timedelta(days=1)
         await discord.utils.sleep_until(next_report)
+
+
+async def setup(bot):
+    await bot.add_cog(StatsCog(bot, bot.user_levels_collection, bot.user_stats, bot.user_resolver, bot.leaderboards,
+                               bot.dispatcher, bot.study_history, bot.charts))
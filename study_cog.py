@@ -1,22 +1,51 @@
 import datetime
+import time
+
 import pytz
 import discord
 from discord.app_commands import describe
 from discord.ext import commands, tasks
 from discord.ext.commands import hybrid_command, is_owner
+
+from scheduler import DeadlineScheduler
+
 TIMEZONE = pytz.timezone('America/New_York')
+ROLLOVER_LEASE_SECONDS = 60 * 60
+
+
+def pomodoro_state(timer, at):
+    """Return (current_cycle, on_break, next_deadline) of a Pomodoro timer at POSIX time `at`, or None once it has ended."""
+    start = timer['start_time'].timestamp()
+    study, pause = timer['study_time'] * 60, timer['break_time'] * 60
+    period = study + pause
+    elapsed = at - start
+    if elapsed >= period * timer['cycles']:
+        return None
+    cycle = int(max(elapsed, 0) // period)
+    on_break = elapsed - cycle * period >= study
+    if on_break:
+        return cycle, True, start + (cycle + 1) * period
+    return cycle, False, start + cycle * period + study
 
 
 class StudyCog(commands.Cog, name="Study Commands"):
-    def __init__(self, bot, study_times_collection, timers_collection, user_daily_study_time_collection, guild_id):
+    QUERY_SHAPES = [
+        ('study_times', {'user_id': '0', 'channel_id': '0'}, None),
+        ('study_times', {'check_in_time': {'$exists': True}}, None),
+        ('timers', {'user_id': 0}, None),
+    ]
+
+    def __init__(self, bot, sessions, timers_collection, guild_id, rollover, dispatcher, leases):
         self.bot = bot
-        self.study_times_collection = study_times_collection
+        self.sessions = sessions
+        self.dispatcher = dispatcher
         self.timers_collection = timers_collection
-        self.check_timers.start()
+        self.pomodoro_scheduler = DeadlineScheduler("PomodoroScheduler")
+        self._timers = {}  # user id -> the timer dict currently running for them
         self.guild_id = guild_id
-        self.reset_daily_study_time.start()
-        self.user_daily_study_time_collection = user_daily_study_time_collection
-        self.update_daily_study_time.start()
+        self.rollover = rollover
+        self.leases = leases
+        self.daily_rollover.start()
 
     @hybrid_command()
     @is_owner()
@@ -35,19 +64,9 @@ class StudyCog(commands.Cog, name="Study Commands"):
         """Indicate that you're starting your study session."""
         user_id = str(ctx.message.author.id)
         channel_id = str(ctx.channel.id)
-        user_data = self.study_times_collection.find_one({'user_id': user_id, 'channel_id': channel_id})
-
-        # Check if the user has already checked in
-        if user_data and 'check_in_time' in user_data:
+        if not await self.sessions.check_in(user_id, channel_id):
             await ctx.send(f'{ctx.message.author.mention} already checked in!')
             return
-
-        check_in_time = datetime.datetime.now()
-        self.study_times_collection.update_one(
-            {'user_id': user_id, 'channel_id': channel_id},
-            {'$set': {'check_in_time': check_in_time}},
-            upsert=True
-        )
         await ctx.send(f'{ctx.message.author.mention} checked in!')
 
     @hybrid_command(aliases=['co'])
@@ -55,72 +74,39 @@ class StudyCog(commands.Cog, name="Study Commands"):
         """Indicate that you're done studying."""
         user_id = str(ctx.message.author.id)
         channel_id = str(ctx.channel.id)
-        user_data = self.study_times_collection.find_one({'user_id': user_id, 'channel_id': channel_id})
-        
-        if user_data and 'check_in_time' in user_data:
-            check_out_time = datetime.datetime.now()
-            study_time = (check_out_time - user_data['check_in_time']).total_seconds()
-            
-            self.study_times_collection.update_one(
-                {'user_id': user_id, 'channel_id': channel_id},
-                {'$inc': {'total_study_time': study_time, 'daily_study_time': study_time}, '$unset': {'check_in_time': ""}},
-                upsert=True
-            )
-
-            current_date = datetime.datetime.now().strftime('%Y-%m-%d')
-            self.user_daily_study_time_collection.update_one(
-                {'user_id': user_id, 'channel_id': channel_id, 'date': current_date},
-                {'$inc': {'study_time_this_day': study_time}},
-                upsert=True
-            )
-
-            if 'goal' in user_data:
-                goal_progress = user_data.get('daily_study_time', 0) + study_time
-                if goal_progress >= user_data['goal']:
-                    await ctx.send(
-                        f'{ctx.message.author.mention} checked out and reached their study goal for today! Congratulations!'
-                        f'{ctx.message.author.mention} has focused ' f'**{round(goal_progress / 60, 2)}** minutes today!'
-                        )
-                else:
-                    await ctx.send(
-                        f'{ctx.message.author.mention} checked out and is '
-                        f'**{round((user_data["goal"] - goal_progress) / 60, 2)}** minutes away from their study goal.'
-                        f'{ctx.message.author.mention} has focused ' f'**{round(goal_progress / 60, 2)}** minutes today!'
+        guild_id = str(ctx.guild.id) if ctx.guild else None
+        session = self.sessions.check_out(user_id, channel_id, guild_id)
+        if session is None:
+            await ctx.send(f'{ctx.message.author.mention} please check in before checking out!')
+            return
+
+        if session['goal'] is not None:
+            goal_progress = session['daily_study_time']
+            if goal_progress >= session['goal']:
+                await ctx.send(
+                    f'{ctx.message.author.mention} checked out and reached their study goal for today! Congratulations!'
+                    f'{ctx.message.author.mention} has focused ' f'**{round(goal_progress / 60, 2)}** minutes today!'
                     )
             else:
-                await ctx.send(f'{ctx.message.author.mention} checked out!')
+                await ctx.send(
+                    f'{ctx.message.author.mention} checked out and is '
+                    f'**{round((session["goal"] - goal_progress) / 60, 2)}** minutes away from their study goal.'
+                    f'{ctx.message.author.mention} has focused ' f'**{round(goal_progress / 60, 2)}** minutes today!'
+                )
         else:
-            await ctx.send(f'{ctx.message.author.mention} please check in before checking out!')
-            return
-        
+            await ctx.send(f'{ctx.message.author.mention} checked out!')
+
     @tasks.loop(hours=24)
-    async def reset_daily_study_time(self):
-        self.study_times_collection.update_many({}, {'$set': {'daily_study_time': 0}})
-    @reset_daily_study_time.before_loop
-    async def before_reset_daily_study_time(self):
+    async def daily_rollover(self):
+        self.sessions.reset_daily()
+        await self.run_rollover(self.rollover.run, datetime.datetime.now(TIMEZONE).strftime('%Y-%m-%d'))
+
+    @daily_rollover.before_loop
+    async def before_daily_rollover(self):
         now = datetime.datetime.now(TIMEZONE)
-        next_reset_time = now.replace(hour=0, minute=0, second=0)
-        if now != next_reset_time:
-            next_reset_time += datetime.timedelta(days=1)
+        next_reset_time = now.replace(hour=0, minute=0, second=0) + datetime.timedelta(days=1)
         await discord.utils.sleep_until(next_reset_time)
 
-    @tasks.loop(hours=24)
-    async def update_daily_study_time(self):
-        current_date = datetime.datetime.now(TIMEZONE).strftime('%Y-%m-%d')
-        for guild in self.bot.guilds:
-            for member in guild.members:
-                user_id = str(member.id)
-                self.user_daily_study_time_collection.update_one(
-                    {'user_id': user_id, 'date': current_date},
-                    {'$set': {'study_time_this_day': 0}},
-                    upsert=True
-                )
-    @update_daily_study_time.before_loop
-    async def before_update_daily_study_time(self):
-        now = datetime.datetime.now(TIMEZONE)
-        next_update_time = now.replace(hour=0, minute=0, second=0) + datetime.timedelta(days=1)
-        await discord.utils.sleep_until(next_update_time)
-    
     @hybrid_command(aliases=["sg"])
     async def set_goal(self, ctx, goal: int):
         """Set your daily study goal (in minutes). For example set a 30 minutes goal: !set_gal 30 """
@@ -130,53 +116,102 @@ class StudyCog(commands.Cog, name="Study Commands"):
         
         user_id = str(ctx.message.author.id)
         channel_id = str(ctx.channel.id)
-        self.study_times_collection.update_one(
-            {'user_id': user_id, 'channel_id': channel_id},
-            {'$set': {'goal': goal * 60}},
-            upsert=True
-        )
+        await self.sessions.set_goal(user_id, channel_id, goal * 60)
         await ctx.send(f'{ctx.message.author.mention} set a study goal of {goal} minutes!')
 
+    async def run_rollover(self, job, *args):
+        """Run a rollover job in one process of the cluster; finished dates are skipped, so a late runner is a no-op."""
+        if not await self.leases.acquire('daily_rollover', ttl=ROLLOVER_LEASE_SECONDS):
+            return
+        try:
+            return await job(*args)
+        finally:
+            await self.leases.release('daily_rollover')
+
+    async def cog_load(self):
+        today = datetime.datetime.now(TIMEZONE).strftime('%Y-%m-%d')
+        if await self.run_rollover(self.rollover.resume_interrupted, today):
+            self.sessions.reset_daily()
+        await self.sessions.load()
+        self.pomodoro_scheduler.start()
+        for timer in await self.timers_collection.find():
+            # Each process drives the timers started in its own guilds; DM-started timers belong to shard 0
+            if self.bot.owns_guild(timer.get('guild_id')):
+                self._timers[timer['user_id']] = timer
+                await self.advance_timer(timer, notify=False)
+
     def cog_unload(self):
-        self.check_timers.cancel()
+        self.pomodoro_scheduler.stop()
+        self.daily_rollover.cancel()
 
     @hybrid_command(aliases=['po'])
     @describe(study_time="study time", break_time="break time", cycles="how many cycles")
     async def start_pomodoro(self, ctx, study_time: int, break_time: int = 5, cycles: int = 1):
         """Start a Pomodoro timer.!start_pomodoro 25 5 4 """
+        if study_time < 1 or break_time < 0 or cycles < 1:
+            await ctx.send(f"{ctx.message.author.mention} study time and cycles must be at least 1, break time at least 0.")
+            return
         timer = {
             'user_id': ctx.author.id,
-            'start_time': datetime.datetime.now(),
+            'guild_id': ctx.guild.id if ctx.guild else None,
+            # Whole seconds, so the value read back from Mongo (millisecond precision) still matches it
+            'start_time': datetime.datetime.now().replace(microsecond=0),
             'study_time': study_time,
             'break_time': break_time,
             'cycles': cycles,
             'current_cycle': 0,
             'on_break': False
         }
-        self.timers_collection.insert_one(timer)
+        self._timers[ctx.author.id] = timer
+        await self.timers_collection.replace_one({'user_id': ctx.author.id}, timer, upsert=True)
+        if self.is_running(timer):
+            self.schedule_timer(timer, pomodoro_state(timer, time.time()))
         await ctx.send(f"{ctx.message.author.mention} Pomodoro timer started!")
 
     @hybrid_command(aliases=['spo'])
     async def stop_pomodoro(self, ctx):
         """Stop a Pomodoro timer."""
-        self.timers_collection.delete_one({'user_id': ctx.author.id})
+        self.pomodoro_scheduler.cancel(ctx.author.id)
+        self._timers.pop(ctx.author.id, None)
+        await self.timers_collection.delete_one({'user_id': ctx.author.id})
         await ctx.send(f"{ctx.message.author.mention} Pomodoro timer stopped!")
 
-    @tasks.loop(seconds=60)
-    async def check_timers(self):
-        """Check timers and send notifications."""
-        for timer in self.timers_collection.find():
-            elapsed_time = datetime.datetime.now() - timer['start_time']
-            total_time = (timer['study_time'] + timer['break_time']) * timer['cycles']
-            if elapsed_time.total_seconds() >= total_time:
-                self.timers_collection.delete_one({'user_id': timer['user_id']})
-                await self.bot.get_user(timer['user_id']).send("Your Pomodoro timer has ended!")
-            elif not timer['on_break'] and elapsed_time.total_seconds() >= timer['study_time'] * (
-                    timer['current_cycle'] + 1):
-                self.timers_collection.update_one({'user_id': timer['user_id']}, {'$set': {'on_break': True}})
-                await self.bot.get_user(timer['user_id']).send("Time for a break!")
-            elif timer['on_break'] and elapsed_time.total_seconds() >= (timer['study_time'] + timer['break_time']) * (
-                    timer['current_cycle'] + 1):
-                self.timers_collection.update_one({'user_id': timer['user_id']},
-                                                  {'$inc': {'current_cycle': 1}, '$set': {'on_break': False}})
-                await self.bot.get_user(timer['user_id']).send("Break's over, back to work!")
+    def is_running(self, timer):
+        """False once the timer was stopped or replaced by a new one, e.g. while one of its writes was in flight."""
+        return self._timers.get(timer['user_id']) is timer
+
+    def schedule_timer(self, timer, state):
+        _, _, deadline = state
+        self.pomodoro_scheduler.schedule(timer['user_id'], deadline, lambda: self.advance_timer(timer))
+
+    async def advance_timer(self, timer, notify=True):
+        """Move a timer to its phase for the current time, persisting and announcing only actual transitions."""
+        if not self.is_running(timer):
+            return
+        # Filtering on start_time keeps a stale transition from writing to a timer started in the meantime
+        timer_filter = {'user_id': timer['user_id'], 'start_time': timer['start_time']}
+        state = pomodoro_state(timer, time.time())
+        if state is None:
+            del self._timers[timer['user_id']]
+            await self.timers_collection.delete_one(timer_filter)
+            if notify:
+                self.dispatcher.send(timer['user_id'], "Your Pomodoro timer has ended!")
+            return
+
+        cycle, on_break, _ = state
+        if (cycle, on_break) != (timer['current_cycle'], timer['on_break']):
+            timer['current_cycle'], timer['on_break'] = cycle, on_break
+            await self.timers_collection.update_one(timer_filter,
+                                                    {'$set': {'current_cycle': cycle, 'on_break': on_break}})
+            if not self.is_running(timer):
+                return
+            self.schedule_timer(timer, state)
+            if notify:
+                self.dispatcher.send(timer['user_id'], "Time for a break!" if on_break else "Break's over, back to work!")
+        else:
+            self.schedule_timer(timer, state)
+
+
+async def setup(bot):
+    await bot.add_cog(StudyCog(bot, bot.sessions, bot.timers_collection, bot.dev_guild, bot.rollover, bot.dispatcher,
+                               bot.leases))
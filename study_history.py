@@ -0,0 +1,160 @@
+import datetime
+
+from pymongo import UpdateOne
+
+from logger_config import setup_logger
+
+DAYS_PER_BUCKET = 31
+STREAK_WINDOW_MONTHS = 2
+
+
+def month_key(day):
+    return day.strftime('%Y-%m')
+
+
+def _months(start, end):
+    """Month keys from `start` to `end` (dates), inclusive."""
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield f"{year:04d}-{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _first_month(day, months):
+    """The first day of the month `months - 1` months before `day`'s."""
+    first = day.replace(day=1)
+    for _ in range(months - 1):
+        first = (first - datetime.timedelta(days=1)).replace(day=1)
+    return first
+
+
+def _daily_series(buckets, start, end):
+    series = []
+    day = start
+    while day <= end:
+        days = buckets.get(month_key(day))
+        series.append((day, days[day.day - 1] if days else 0))
+        day += datetime.timedelta(days=1)
+    return series
+
+
+def _streak(buckets, today):
+    def studied(day):
+        days = buckets.get(month_key(day))
+        return bool(days and days[day.day - 1] > 0)
+
+    day = today if studied(today) else today - datetime.timedelta(days=1)
+    streak = 0
+    while studied(day):
+        streak += 1
+        day -= datetime.timedelta(days=1)
+    return streak
+
+
+class StudyHistory:
+    """Per-user daily study time, bucketed into one `study_history` document per user per month.
+
+    Each bucket holds a fixed 31-slot `days` array (slot 0 is the 1st) and the month's `total`, so a week, month or
+    year of history is one indexed read of at most 13 small documents, and only users who actually study get
+    documents. Writes go through the write buffer: the bucket is created zero-filled on first use, then the day's slot
+    is incremented.
+    """
+    LOG = setup_logger("StudyHistory")
+
+    def __init__(self, study_history_collection, write_buffer):
+        self.study_history_collection = study_history_collection
+        self.write_buffer = write_buffer
+
+    def add_study_time(self, user_id, study_time, day):
+        key = {'user_id': user_id, 'month': month_key(day)}
+        # $inc on a missing array creates an object, so the zero-filled array must exist first
+        self.write_buffer.add(self.study_history_collection, UpdateOne(
+            key, {'$setOnInsert': {'days': [0] * DAYS_PER_BUCKET, 'total': 0}}, upsert=True))
+        self.write_buffer.add(self.study_history_collection, UpdateOne(
+            key, {'$inc': {f'days.{day.day - 1}': study_time, 'total': study_time}}))
+
+    async def buckets(self, user_id, start=None, end=None):
+        """Return a dict of month key -> `days` list for the user's buckets between `start` and `end` (dates)."""
+        await self.write_buffer.flush_pending(self.study_history_collection)
+        query = {'user_id': user_id}
+        if start is not None or end is not None:
+            query['month'] = {}
+            if start is not None:
+                query['month']['$gte'] = month_key(start)
+            if end is not None:
+                query['month']['$lte'] = month_key(end)
+        documents = await self.study_history_collection.find(query, {'_id': 0, 'month': 1, 'days': 1})
+        return {document['month']: document['days'] for document in documents}
+
+    async def daily(self, user_id, start, end):
+        """Return [(date, seconds)] for every day from `start` to `end` inclusive, zeros included."""
+        return _daily_series(await self.buckets(user_id, start, end), start, end)
+
+    async def monthly(self, user_id, start, end):
+        """Return [(month key, seconds)] for every month from `start` to `end` inclusive."""
+        buckets = await self.buckets(user_id, start, end)
+        return [(month, sum(buckets.get(month, []))) for month in _months(start, end)]
+
+    async def total(self, user_id, start, end):
+        return sum(seconds for _, seconds in await self.daily(user_id, start, end))
+
+    async def streak(self, user_id, today, months=STREAK_WINDOW_MONTHS):
+        """Consecutive days with study time ending today, or yesterday if nothing has been logged yet today.
+
+        Reads the last `months` months, and earlier ones (twice as many each time) only while the streak reaches back
+        to the first day read.
+        """
+        buckets, end = {}, today
+        while True:
+            start = _first_month(end, months)
+            buckets.update(await self.buckets(user_id, start, end))
+            streak = _streak(buckets, today)
+            if today - datetime.timedelta(days=streak) > start:
+                return streak
+            end, months = start - datetime.timedelta(days=1), months * 2
+
+    async def overview(self, user_id, today, days=30, weeks=12, months=12):
+        """Daily, weekly (Monday-based) and monthly series ending at `today`, plus the streak, from one read."""
+        first_month = _first_month(today, months)
+        first_week = today - datetime.timedelta(days=today.weekday(), weeks=weeks - 1)
+        start = min(first_month, first_week, today - datetime.timedelta(days=days - 1))
+        buckets = await self.buckets(user_id, start, today)
+
+        daily = _daily_series(buckets, start, today)
+        weekly = [(week, sum(seconds for _, seconds in daily[index:index + 7]))
+                  for index, (week, _) in enumerate(daily) if week >= first_week and week.weekday() == 0]
+        streak = _streak(buckets, today)
+        if streak and today - datetime.timedelta(days=streak) <= start:
+            # The streak runs past the window that was read
+            streak = await self.streak(user_id, today)
+        return {
+            'daily': daily[-days:],
+            'weekly': weekly,
+            'monthly': [(month, sum(buckets.get(month, []))) for month in _months(first_month, today)],
+            'streak': streak,
+        }
+
+    async def load(self, user_daily_study_time_collection, leases):
+        # One process backfills; the others wait, so none queues an $inc that the backfill's $set would overwrite
+        await leases.run_once('backfill_study_history', self._has_history,
+                              lambda: self.backfill(user_daily_study_time_collection))
+
+    async def _has_history(self):
+        return await self.study_history_collection.count_documents({}, limit=1) > 0
+
+    async def backfill(self, user_daily_study_time_collection):
+        """Build the monthly buckets once from the legacy per-channel, per-day documents, skipping zero days."""
+        buckets = {}
+        for row in await user_daily_study_time_collection.aggregate([
+            {'$match': {'study_time_this_day': {'$gt': 0}}},
+            {'$group': {'_id': {'user_id': '$user_id', 'date': '$date'}, 'study_time': {'$sum': '$study_time_this_day'}}}
+        ]):
+            day = datetime.datetime.strptime(row['_id']['date'], '%Y-%m-%d')
+            days = buckets.setdefault((row['_id']['user_id'], month_key(day)), [0] * DAYS_PER_BUCKET)
+            days[day.day - 1] += row['study_time']
+        if buckets:
+            await self.study_history_collection.bulk_write([
+                UpdateOne({'user_id': user_id, 'month': month}, {'$set': {'days': days, 'total': sum(days)}}, upsert=True)
+                for (user_id, month), days in buckets.items()
+            ])
+        self.LOG.info(f"backfilled {len(buckets)} study_history buckets from user_daily_study_time")
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from discord.ext import commands
+
+from metrics import COMMAND_CACHE_REQUESTS, THROTTLED_COMMANDS
+
+COMMAND_CACHE_TTL = 30
+COMMAND_CACHE_SIZE = 1024
+THROTTLE_RATE = 1 / 3
+THROTTLE_BURST = 5
+THROTTLE_MAX_USERS = 10000
+
+
+class ResultCache:
+    """Short-lived cache of command results in which concurrent requests for the same key share one computation.
+
+    Keys should include a version of the data the result is built from, so a cached result is only ever served until
+    that data changes; the TTL bounds how stale it can get when the data is written elsewhere (another process).
+    Failed computations are not cached. Lookups are counted per cache as hit, coalesced or miss.
+    """
+
+    def __init__(self, name, ttl=COMMAND_CACHE_TTL, maxsize=COMMAND_CACHE_SIZE):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self._computing = {}
+
+    async def get(self, key, compute):
+        """Return the cached result for `key`, or await `compute()` (a coroutine function) and cache its result."""
+        entry = self._results.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._results.move_to_end(key)
+            COMMAND_CACHE_REQUESTS.inc(cache=self.name, result='hit')
+            return entry[0]
+        if key in self._computing:
+            COMMAND_CACHE_REQUESTS.inc(cache=self.name, result='coalesced')
+        else:
+            COMMAND_CACHE_REQUESTS.inc(cache=self.name, result='miss')
+            self._computing[key] = asyncio.ensure_future(self._compute(key, compute))
+        # One caller giving up (a cancelled command) must not cancel the computation the others wait on
+        return await asyncio.shield(self._computing[key])
+
+    async def _compute(self, key, compute):
+        try:
+            result = await compute()
+        finally:
+            del self._computing[key]
+        self._results[key] = (result, time.monotonic() + self.ttl)
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+        return result
+
+
+class UserRateLimiter:
+    """Per-user token buckets: `burst` commands at once, refilled at `rate` commands per second.
+
+    Buckets are kept for the `max_users` most recently active users; an evicted user simply starts with a full bucket.
+    """
+
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST, max_users=THROTTLE_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+
+    def acquire(self, user_id):
+        """Take a token for `user_id`; returns 0 if the command may run, else the seconds until it may."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[user_id] = (tokens - 1, now)
+        self._buckets.move_to_end(user_id)
+        while len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return 0
+
+
+class Throttled(commands.CheckFailure):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"You are using this command too often. Try again in {retry_after:.0f}s.")
+
+
+def throttled():
+    """Command check that spends a token from the invoking user's bucket in `bot.command_limiter`."""
+    async def predicate(ctx):
+        retry_after = ctx.bot.command_limiter.acquire(ctx.author.id)
+        if retry_after:
+            THROTTLED_COMMANDS.inc(command=ctx.command.qualified_name)
+            raise Throttled(retry_after)
+        return True
+    return commands.check(predicate)
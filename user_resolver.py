@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+from logger_config import setup_logger
+
+UNKNOWN_USER = "Unknown user"
+
+
+class UserNameResolver:
+    """Resolves user ids to display names with as few REST calls as possible.
+
+    Lookup order: the gateway member/user cache, then an LRU cache of names with a TTL, and only then
+    concurrent `fetch_user` calls bounded by a semaphore. Hit/miss counters are kept in `stats`.
+    """
+    LOG = setup_logger("UserNameResolver")
+
+    def __init__(self, bot, maxsize=10000, ttl=60 * 60, concurrency=10):
+        self.bot = bot
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._names = OrderedDict()
+        self.stats = {'gateway_hits': 0, 'cache_hits': 0, 'cache_misses': 0, 'fetch_errors': 0}
+
+    def _cached(self, user_id):
+        entry = self._names.get(user_id)
+        if entry is None:
+            return None
+        name, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._names[user_id]
+            return None
+        self._names.move_to_end(user_id)
+        return name
+
+    def _store(self, user_id, name):
+        self._names[user_id] = (name, time.monotonic() + self.ttl)
+        self._names.move_to_end(user_id)
+        while len(self._names) > self.maxsize:
+            self._names.popitem(last=False)
+
+    def _from_gateway(self, user_id, guild):
+        user = (guild.get_member(user_id) if guild else None) or self.bot.get_user(user_id)
+        return user.display_name if user else None
+
+    async def _fetch(self, user_id):
+        async with self._semaphore:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord.HTTPException as e:
+                self.stats['fetch_errors'] += 1
+                self.LOG.warning(f"could not fetch user {user_id}: {e}")
+                return user_id, UNKNOWN_USER
+        self._store(user_id, user.display_name)
+        return user_id, user.display_name
+
+    async def resolve_many(self, user_ids, guild=None):
+        """Return a dict of user id -> display name for every id in `user_ids`."""
+        names = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            name = self._from_gateway(user_id, guild)
+            if name is not None:
+                self.stats['gateway_hits'] += 1
+                names[user_id] = name
+                continue
+            name = self._cached(user_id)
+            if name is not None:
+                self.stats['cache_hits'] += 1
+                names[user_id] = name
+                continue
+            self.stats['cache_misses'] += 1
+            missing.append(user_id)
+
+        if missing:
+            names.update(await asyncio.gather(*(self._fetch(user_id) for user_id in missing)))
+        return names
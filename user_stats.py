@@ -0,0 +1,110 @@
+import datetime
+
+from pymongo import UpdateOne
+
+from logger_config import setup_logger
+
+
+def week_start(day):
+    return (day - datetime.timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+
+
+def _period_total(field, period_field, period, amount):
+    """Pipeline expression adding `amount` to `field`, restarting from zero when `period_field` rolls over."""
+    return {'$cond': [{'$eq': [f'${period_field}', period]},
+                      {'$add': [{'$ifNull': [f'${field}', 0]}, amount]},
+                      amount]}
+
+
+class UserStatsService:
+    """Precomputed per-user counters in the `user_stats` collection, one document per user.
+
+    Study time is kept as all-time, daily and weekly totals, where the daily/weekly values carry the date/week they
+    belong to and restart when it changes. Quiz answers are kept as answered/correct counts. Reports then cost a
+    single indexed read regardless of how much history a user has. Counter updates go through the write buffer.
+
+    `version(user_id)` changes on every study time or answer recorded in this process, so it can key cached reports.
+    """
+    LOG = setup_logger("UserStatsService")
+
+    def __init__(self, user_stats_collection, write_buffer):
+        self.user_stats_collection = user_stats_collection
+        self.write_buffer = write_buffer
+        self._versions = {}
+
+    def version(self, user_id):
+        return self._versions.get(user_id, 0)
+
+    def _changed(self, user_id):
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    async def get(self, user_id):
+        await self.write_buffer.flush_pending(self.user_stats_collection)
+        return await self.user_stats_collection.find_one({'user_id': user_id})
+
+    async def get_many(self, user_ids):
+        """Return a dict of user id -> stats document for the ids that have one."""
+        await self.write_buffer.flush_pending(self.user_stats_collection)
+        documents = await self.user_stats_collection.find({'user_id': {'$in': list(user_ids)}})
+        return {document['user_id']: document for document in documents}
+
+    def add_study_time(self, user_id, study_time, now=None):
+        now = now or datetime.datetime.now()
+        today, this_week = now.strftime('%Y-%m-%d'), week_start(now)
+        self._changed(user_id)
+        self.write_buffer.add(self.user_stats_collection, UpdateOne({'user_id': user_id}, [{'$set': {
+            'total_study_time': {'$add': [{'$ifNull': ['$total_study_time', 0]}, study_time]},
+            'daily_study_time': _period_total('daily_study_time', 'daily_date', today, study_time),
+            'weekly_study_time': _period_total('weekly_study_time', 'week_start', this_week, study_time),
+            'daily_date': today,
+            'week_start': this_week,
+        }}], upsert=True))
+
+    def add_answer(self, user_id, correct):
+        self._changed(user_id)
+        self.write_buffer.add(self.user_stats_collection, UpdateOne(
+            {'user_id': user_id},
+            {'$inc': {'quiz_answered': 1, 'quiz_correct': int(correct)}},
+            upsert=True
+        ))
+
+    async def set_level(self, user_id, xp, level):
+        await self.user_stats_collection.update_one({'user_id': user_id}, {'$set': {'xp': xp, 'level': level}})
+
+    async def load(self, study_times_collection, user_answers_collection, user_daily_study_time_collection, leases):
+        # One process backfills; the others wait, so none queues an $inc that the backfill's $set would overwrite
+        await leases.run_once('backfill_user_stats', self._has_stats, lambda: self.backfill(
+            study_times_collection, user_answers_collection, user_daily_study_time_collection))
+
+    async def _has_stats(self):
+        return await self.user_stats_collection.count_documents({}, limit=1) > 0
+
+    async def backfill(self, study_times_collection, user_answers_collection, user_daily_study_time_collection):
+        """Build the counters once from the raw study_times, user_answers and user_daily_study_time documents."""
+        now = datetime.datetime.now()
+        today, this_week = now.strftime('%Y-%m-%d'), week_start(now)
+        end_of_week = (now - datetime.timedelta(days=now.weekday()) + datetime.timedelta(days=6)).strftime('%Y-%m-%d')
+        stats = {}
+
+        def user(user_id):
+            return stats.setdefault(str(user_id), {'daily_date': today, 'week_start': this_week})
+
+        for row in await study_times_collection.aggregate([
+            {'$group': {'_id': '$user_id', 'total': {'$sum': '$total_study_time'}, 'daily': {'$sum': '$daily_study_time'}}}
+        ]):
+            user(row['_id']).update(total_study_time=row['total'], daily_study_time=row['daily'])
+        for row in await user_answers_collection.aggregate([
+            {'$group': {'_id': '$user_id', 'answered': {'$sum': 1}, 'correct': {'$sum': {'$cond': ['$correct', 1, 0]}}}}
+        ]):
+            user(row['_id']).update(quiz_answered=row['answered'], quiz_correct=row['correct'])
+        for row in await user_daily_study_time_collection.aggregate([
+            {'$match': {'date': {'$gte': this_week, '$lte': end_of_week}}},
+            {'$group': {'_id': '$user_id', 'weekly': {'$sum': '$study_time_this_day'}}}
+        ]):
+            user(row['_id'])['weekly_study_time'] = row['weekly']
+
+        if stats:
+            await self.user_stats_collection.bulk_write([
+                UpdateOne({'user_id': user_id}, {'$set': fields}, upsert=True) for user_id, fields in stats.items()
+            ])
+        self.LOG.info(f"backfilled user_stats for {len(stats)} users")
@@ -0,0 +1,73 @@
+import discord
+from discord.app_commands import describe
+from discord.ext import commands, tasks
+from discord.ext.commands import has_guild_permissions, hybrid_command
+
+from logger_config import setup_logger
+
+VOICE_FLUSH_SECONDS = 5
+
+
+class VoiceCog(commands.Cog, name="Voice Study Tracking"):
+    LOG = setup_logger("VoiceCog")
+    QUERY_SHAPES = [
+        ('study_times', {'$or': [{'channel_id': '0', 'user_id': {'$in': ['0']}}]}, None),
+    ]
+
+    def __init__(self, bot, presence, guild_config):
+        self.bot = bot
+        self.presence = presence
+        self.guild_config = guild_config
+
+    async def cog_load(self):
+        self.flush_presence.start()
+
+    def cog_unload(self):
+        self.flush_presence.cancel()
+
+    @tasks.loop(seconds=VOICE_FLUSH_SECONDS)
+    async def flush_presence(self):
+        await self.presence.flush()
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.bot or before.channel == after.channel:
+            return
+        channel = after.channel
+        if channel is not None and channel.id not in self.guild_config.study_voice_channel_ids(member.guild.id):
+            channel = None
+        self.presence.record(str(member.id), str(member.guild.id), str(channel.id) if channel is not None else None)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Voice states are only known once the gateway cache is filled, and changes during an outage were missed
+        await self.reconcile()
+
+    async def reconcile(self, removed=()):
+        # Sessions in channels that are no longer tracked are closed like those of users who left
+        channels = {str(channel.id): str(channel.guild.id) for channel in removed}
+        present = {}
+        for guild in self.bot.guilds:
+            for channel_id in self.guild_config.study_voice_channel_ids(guild.id):
+                channels[str(channel_id)] = str(guild.id)
+                channel = guild.get_channel(channel_id)
+                for member in getattr(channel, 'members', []):
+                    if not member.bot:
+                        present[str(member.id)] = (str(channel_id), str(guild.id))
+        await self.presence.reconcile(present, channels)
+
+    @hybrid_command(aliases=['sv'])
+    @has_guild_permissions(manage_channels=True)
+    @describe(channel="the voice channel to track")
+    async def study_voice(self, ctx, channel: discord.VoiceChannel):
+        """Toggle whether time spent in a voice channel counts as study time."""
+        added = await self.guild_config.toggle_list_value(ctx.guild.id, 'study_voice_channel_ids', channel.id)
+        await self.reconcile(removed=[] if added else [channel])
+        if added:
+            await ctx.send(f"Time spent in {channel.mention} now counts as study time.")
+        else:
+            await ctx.send(f"Time spent in {channel.mention} no longer counts as study time.")
+
+
+async def setup(bot):
+    await bot.add_cog(VoiceCog(bot, bot.voice_presence, bot.guild_config))
@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import time
+
+from logger_config import setup_logger
+
+VOICE_DEBOUNCE_SECONDS = 30
+
+
+class VoicePresence:
+    """Turns voice-state changes in study voice channels into study sessions, debounced and applied in batches.
+
+    `record` only notes where a user is now, in memory; a user's changes are coalesced until none has arrived for
+    `debounce` seconds, so hopping between channels or dropping out for a moment costs nothing and a user who comes
+    back to where they were has no change at all. `flush` then checks settled users out of their previous channel as
+    of when they first left it (through the write buffer) and checks them all into their new channels with one bulk
+    write. `reconcile` aligns the sessions with the actual voice states after a restart or reconnect.
+    """
+    LOG = setup_logger("VoicePresence")
+
+    def __init__(self, sessions, debounce=VOICE_DEBOUNCE_SECONDS):
+        self.sessions = sessions
+        self.debounce = debounce
+        self._current = {}  # user id -> (channel_id, guild_id) of the voice session open for them
+        self._pending = {}  # user id -> change waiting to settle
+        self._lock = asyncio.Lock()
+        self.stats = {'events': 0, 'coalesced': 0, 'check_ins': 0, 'check_outs': 0, 'batches': 0}
+
+    def __len__(self):
+        return len(self._current)
+
+    @property
+    def backlog(self):
+        return len(self._pending)
+
+    def record(self, user_id, guild_id, channel_id, at=None):
+        """Note that `user_id` is now in the study voice channel `channel_id`, or in none if it is None."""
+        self.stats['events'] += 1
+        current = self._current.get(user_id, (None, None))[0]
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            self.stats['coalesced'] += 1
+            if channel_id == current:
+                del self._pending[user_id]
+            else:
+                pending.update(channel_id=channel_id, guild_id=guild_id, joined_at=at or datetime.datetime.now(),
+                               changed_at=time.monotonic())
+            return
+        if channel_id == current:
+            return
+        at = at or datetime.datetime.now()
+        self._pending[user_id] = {'channel_id': channel_id, 'guild_id': guild_id, 'left_at': at, 'joined_at': at,
+                                  'changed_at': time.monotonic()}
+
+    async def flush(self, force=False):
+        """Apply the changes that have settled (all of them if `force`); returns the number applied."""
+        async with self._lock:
+            return await self._flush(force)
+
+    async def _flush(self, force):
+        settled_before = time.monotonic() - (0 if force else self.debounce)
+        settled = [(user_id, change) for user_id, change in self._pending.items()
+                   if change['changed_at'] <= settled_before]
+        if not settled:
+            return 0
+        check_ins = []
+        for user_id, change in settled:
+            del self._pending[user_id]
+            current = self._current.pop(user_id, None)
+            if current is not None and self.sessions.check_out(user_id, current[0], current[1], change['left_at']):
+                self.stats['check_outs'] += 1
+            if change['channel_id'] is not None:
+                self._current[user_id] = (change['channel_id'], change['guild_id'])
+                check_ins.append((user_id, change['channel_id'], change['joined_at']))
+        if check_ins:
+            self.stats['check_ins'] += await self.sessions.check_in_many(check_ins)
+        self.stats['batches'] += 1
+        return len(settled)
+
+    async def reconcile(self, present, channels, now=None):
+        """Align the sessions in study voice channels with who is actually in them.
+
+        `present` maps user id -> (channel_id, guild_id) for everyone in a study voice channel and `channels` maps
+        every study voice channel id to its guild id. Pending changes are applied first; then open sessions in those
+        channels whose user is not there are checked out, and present users without one are checked in, as of `now`.
+        """
+        now = now or datetime.datetime.now()
+        async with self._lock:
+            await self._flush(force=True)
+            self._current = {}
+            checked_out = 0
+            for user_id, channel_id in self.sessions.open_in(channels):
+                location = present.get(user_id)
+                if location is not None and location[0] == channel_id and user_id not in self._current:
+                    self._current[user_id] = location
+                elif self.sessions.check_out(user_id, channel_id, channels[channel_id], now):
+                    checked_out += 1
+            check_ins = [(user_id, channel_id, now) for user_id, (channel_id, guild_id) in present.items()
+                         if user_id not in self._current]
+            for user_id, channel_id, _ in check_ins:
+                self._current[user_id] = present[user_id]
+            checked_in = await self.sessions.check_in_many(check_ins) if check_ins else 0
+        self.stats['check_outs'] += checked_out
+        self.stats['check_ins'] += checked_in
+        self.LOG.info(f"reconciled voice sessions: {len(self._current)} in study channels, "
+                      f"{checked_in} checked in, {checked_out} checked out")
@@ -0,0 +1,138 @@
+import asyncio
+import time
+from collections import Counter
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from logger_config import setup_logger
+
+WRITE_BUFFER_MAX_BATCH = 500
+WRITE_BUFFER_FLUSH_INTERVAL = 1.0
+
+
+class WriteBuffer:
+    """Async write-behind buffer that flushes queued pymongo operations as ordered `bulk_write` batches.
+
+    Operations are flushed when `max_batch` of them are queued or every `flush_interval` seconds, one ordered batch per
+    collection so each collection sees its writes in the order they were added. A batch that fails on a connection
+    error is put back at the front of the queue; in a batch rejected by the server only the offending operation is
+    dropped. `close` flushes everything still queued, so writes survive a clean shutdown.
+
+    Callers that need to read their own writes call `flush_pending(collection)` first, which is a no-op when nothing
+    is queued for that collection and otherwise flushes only that collection. Writes added with a `key` can be waited
+    for by key, `flush_pending(collection, key, ...)`, so a caller only pays for a flush when its own document has a
+    write queued.
+    """
+    LOG = setup_logger("WriteBuffer")
+
+    def __init__(self, max_batch=WRITE_BUFFER_MAX_BATCH, flush_interval=WRITE_BUFFER_FLUSH_INTERVAL):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._ops = []
+        self._pending = Counter()
+        self._pending_keys = Counter()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._stopped = asyncio.Event()
+        self._flushes = set()
+        self.stats = {'ops': 0, 'batches': 0, 'errors': 0, 'max_batch_size': 0,
+                      'last_flush_seconds': 0.0, 'max_flush_seconds': 0.0}
+
+    @property
+    def backlog(self):
+        return len(self._ops)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="write-buffer")
+
+    async def close(self):
+        self._stopped.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+        await self.flush()
+        if self._ops:
+            self.LOG.error(f"{len(self._ops)} writes could not be flushed on shutdown")
+
+    def add(self, collection, op, key=None):
+        self._ops.append((collection, op, key))
+        self._pending[collection.name] += 1
+        if key is not None:
+            self._pending_keys[(collection.name, key)] += 1
+        if len(self._ops) >= self.max_batch:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def flush_pending(self, collection, *keys):
+        if keys:
+            pending = any(self._pending_keys[(collection.name, key)] for key in keys)
+        else:
+            pending = self._pending[collection.name]
+        if pending:
+            await self.flush(collection.name)
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self, name=None):
+        """Write everything queued, or only what is queued for the collection called `name`."""
+        async with self._lock:
+            if name is None:
+                ops, self._ops = self._ops, []
+            else:
+                ops = [item for item in self._ops if item[0].name == name]
+                self._ops = [item for item in self._ops if item[0].name != name]
+            if not ops:
+                return
+            batches = {}
+            for collection, op, key in ops:
+                batches.setdefault(collection.name, (collection, []))[1].append((op, key))
+
+            started = time.perf_counter()
+            retry = []
+            for name, (collection, batch) in batches.items():
+                try:
+                    await collection.bulk_write([op for op, _ in batch], ordered=True)
+                    executed = len(batch)
+                except BulkWriteError as e:
+                    # Ordered batches stop at the first failing op; drop it and retry the rest.
+                    failed = e.details['writeErrors'][0]['index']
+                    self.LOG.error(f"dropping write to {name}: {e.details['writeErrors'][0].get('errmsg')}")
+                    self.stats['errors'] += 1
+                    executed = failed
+                    retry.extend((collection, op, key) for op, key in batch[failed + 1:])
+                except PyMongoError as e:
+                    self.LOG.error(f"flush of {len(batch)} writes to {name} failed, requeueing: {e}")
+                    self.stats['errors'] += 1
+                    executed = 0
+                    retry.extend((collection, op, key) for op, key in batch)
+                # Only now, so a flush_pending() for this collection waits for the batch to land instead of returning
+                self._pending[name] -= len(batch)
+                for _, key in batch:
+                    if key is not None:
+                        self._pending_keys[(name, key)] -= 1
+                        if not self._pending_keys[(name, key)]:
+                            del self._pending_keys[(name, key)]
+                self.stats['ops'] += executed
+                self.stats['batches'] += 1
+                self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+
+            for collection, _, key in retry:
+                self._pending[collection.name] += 1
+                if key is not None:
+                    self._pending_keys[(collection.name, key)] += 1
+            self._ops = retry + self._ops
+            elapsed = time.perf_counter() - started
+            self.stats['last_flush_seconds'] = elapsed
+            self.stats['max_flush_seconds'] = max(self.stats['max_flush_seconds'], elapsed)
+            self.LOG.debug(f"flushed {len(ops) - len(retry)} writes in {len(batches)} batches, {elapsed * 1000:.1f}ms, "
+                           f"backlog {len(self._ops)}")